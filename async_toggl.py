@@ -0,0 +1,385 @@
+"""
+Asyncio client of Toggl API
+
+AsyncToggl has the same methods as Toggl, but they are coroutines, so any
+number of workspaces can be polled from a single event loop:
+
+    async def main():
+        toggl = AsyncToggl(api_token)
+        workspaces = await toggl.get_workspaces()
+        reports = await asyncio.gather(*[
+            toggl.detailed_report(w['id'], monday, sunday)
+            for w in workspaces])
+        toggl.close()
+
+Response caching, filtering, rate limiting and retries are shared with Toggl
+(see toggl.BaseToggl). The metadata index, changed_time_entries() and
+sync_changes() rely on blocking code, so they are only available in Toggl.
+Unlike the rest of the package, this module requires Python 3.7+
+"""
+
+import asyncio
+import json
+import ssl
+import time
+import zlib
+
+from toggl import BaseToggl, TogglRateLimitException
+
+
+class AsyncResponse(object):
+    """ Status and headers of a response, as in http.client.HTTPResponse """
+
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers  # lowercase name: value
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class AsyncConnectionPool(object):
+    """ Pool of keep-alive connections (asyncio streams) to the API host
+
+    At most `limit` connections are open at once, other requests wait for a
+    free one. Up to `size` idle connections are kept open for reuse.
+    """
+
+    def __init__(self, host, port, ssl_context=None, size=8, limit=100):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.size = size
+        self.limit = limit
+        self._idle = []  # (reader, writer)
+        self._semaphore = None
+        self._loop = None
+
+    def _check_loop(self):
+        """ Streams and the semaphore belong to an event loop, so start over
+        if the pool is used by a new one, e.g. in another asyncio.run() """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._idle = []
+            self._semaphore = asyncio.Semaphore(self.limit)
+
+    async def acquire(self):
+        """ Get the most recently used idle connection or open a new one
+        :return: (reader, writer, reused)
+        """
+        self._check_loop()
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                reader, writer = self._idle.pop()
+                if not reader.at_eof():
+                    return reader, writer, True
+                writer.close()  # closed by the server
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl_context)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return reader, writer, False
+
+    def release(self, reader, writer, keep_alive=True):
+        """ Return a connection to the pool once its response is read """
+        if keep_alive and len(self._idle) < self.size:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        self._semaphore.release()
+
+    def close(self):
+        """ Close all idle connections """
+        idle, self._idle = self._idle, []
+        if self._loop is None or self._loop.is_closed():
+            return  # transports of a closed loop are gone anyway
+        for _, writer in idle:
+            writer.close()
+
+
+class AsyncToggl(BaseToggl):
+    """ Asyncio version of Toggl, see the module docstring
+
+    Requests are sent by a minimal HTTP/1.1 client over asyncio streams.
+    Cache backends are still blocking, which is fine for MemoryCache and
+    mostly fine for SQLiteCache.
+    """
+    max_connections = 100  # max number of concurrent requests
+
+    def __init__(self, api_token, cache=True, rate_limiter=None,
+                 base_url=None, timeout=None, metrics=None):
+        """ Parameters are the same as of Toggl """
+        super(AsyncToggl, self).__init__(api_token, cache, rate_limiter,
+                                         base_url, timeout, metrics)
+        host, _, port = self.baseURL.partition(':')
+        https = self.scheme == 'https'
+        self.pool = AsyncConnectionPool(
+            host, int(port) if port else 443 if https else 80,
+            ssl.create_default_context() if https else None,
+            self.pool_size, self.max_connections)
+
+    async def _request(self, api_func, params=None, body=None, method='GET',
+                       filters=None):
+        """ Coroutine version of Toggl._request() """
+        url = self._url(api_func, params)
+        if body is not None and method == 'GET':
+            method = 'POST'
+        cache_ttl = self._cache_ttl(api_func, params)
+        cache_tags = self._cache_tags(api_func, params)
+
+        try:
+            for i in range(self.retries):
+                try:
+                    response = await self._get_json(url, method, body=body,
+                                                    cache_ttl=cache_ttl,
+                                                    cache_tags=cache_tags)
+                except TogglRateLimitException as e:
+                    if i == self.retries - 1:
+                        raise e
+                    delay = self._backoff(i, e.retry_after)
+                    if self.metrics is not None:
+                        self.metrics.on_retry(self._endpoint(url), delay)
+                    self.rate_limiter.pause(delay)
+                else:
+                    break
+        finally:
+            # even a failed write might have been applied
+            if method != 'GET':
+                self._invalidate(*self._write_tags(api_func))
+        return self._filter(response, filters)
+
+    async def _get_json(self, url, method='GET', body=None, cache_ttl=None,
+                        cache_tags=()):
+        self.logger.debug("_get_json: url=%s, method=%s, body=%s",
+                          url, method, body)
+        use_cache = self.cache is not None and method == 'GET' and \
+            cache_ttl != 0
+        stale = None
+        if use_cache:
+            response_json, stale = self._lookup(url)
+            if response_json is not None:
+                return response_json
+
+        throttled = max(self.rate_limiter.reserve(), 0)
+        if throttled > 0:
+            await asyncio.sleep(throttled)
+        started = time.time()
+        status = size = None
+        try:
+            response, response_text, size = await self._send(
+                method, url, body, self._headers(stale))
+            status = response.status
+        finally:
+            if self.metrics is not None:
+                self.metrics.on_request(self._endpoint(url), status,
+                                        time.time() - started, size or 0,
+                                        throttled)
+        return self._handle_response(url, response, response_text, use_cache,
+                                     cache_ttl, cache_tags, stale)
+
+    async def _send(self, method, url, body, headers):
+        """ Coroutine version of Toggl._send(), with the same retry rules """
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        body = body or b''
+        lines = ['%s %s HTTP/1.1' % (method, url),
+                 'Host: %s' % self.baseURL,
+                 'Accept-Encoding: gzip',
+                 'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % header for header in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        for attempt in range(2):
+            reader, writer, reused = await self.pool.acquire()
+            keep_alive = False
+            try:
+                response, response_text, size, keep_alive = \
+                    await asyncio.wait_for(
+                        self._exchange(reader, writer, request, method),
+                        self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if reused and attempt == 0 and \
+                        method in self.idempotent_methods:
+                    self.logger.debug("Connection was closed, reconnecting")
+                    continue
+                self.logger.error('Failed to open url: %s' % url)
+                raise
+            except Exception:
+                self.logger.error('Failed to open url: %s' % url)
+                raise
+            finally:
+                self.pool.release(reader, writer, keep_alive)
+            return response, response_text, size
+
+    async def _exchange(self, reader, writer, request, method):
+        """ Send the request and read the response
+        :return: (response, decompressed body, number of bytes received,
+            whether the connection can be reused)
+        """
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError(
+                "Remote end closed connection without response")
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        response = AsyncResponse(int(status), headers)
+        keep_alive = version == b'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+
+        decompressor = None
+        if headers.get('content-encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        size = 0
+
+        def add(chunk):
+            nonlocal size
+            size += len(chunk)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            chunks.append(chunk)
+
+        if method == 'HEAD' or response.status in (204, 304) or \
+                response.status < 200:
+            pass
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                chunk_size = int(
+                    (await reader.readline()).split(b';')[0], 16)
+                if not chunk_size:
+                    break
+                add(await reader.readexactly(chunk_size))
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # trailers
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining:
+                chunk = await reader.read(
+                    min(remaining, self.read_chunk_size))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(chunk)
+                add(chunk)
+        else:  # the body ends when the server closes the connection
+            keep_alive = False
+            while True:
+                chunk = await reader.read(self.read_chunk_size)
+                if not chunk:
+                    break
+                add(chunk)
+        if decompressor is not None:
+            chunks.append(decompressor.flush())
+        return response, b''.join(chunks), size, keep_alive
+
+    def close(self):
+        """ Close idle connections to the API """
+        self.pool.close()
+
+    # Methods returning the result of _request() as is, e.g. get_projects(),
+    # are inherited and return a coroutine. The rest are redefined below
+
+    async def get_workspaces(self, **filters):
+        """ Coroutine version of Toggl.get_workspaces() """
+        data = await self._request('/api/v8/workspaces', filters=filters)
+
+        # filter out personal workspaces:
+        return [w for w in data
+                if 'personal' not in w['name'] and w['admin']]
+
+    async def add_workspace(self, name, admins_only=False, **params):
+        """ Coroutine version of Toggl.add_workspace() """
+        params['name'] = name
+        params['only_admins_see_team_dashboard'] = admins_only
+        await self._request('/api/v9/workspaces', body=json.dumps(params))
+
+    async def delete_workspace(self, wid):
+        """ Coroutine version of Toggl.delete_workspace() """
+        await self._request("/api/v8/workspaces/{}/leave".format(wid),
+                            method='DELETE')
+
+    def get_workspace_users(self, wid, **filters):
+        """ Coroutine version of Toggl.get_workspace_users() """
+        return self._request(
+            '/api/v8/workspaces/{0}/workspace_users'.format(wid),
+            filters=filters)
+
+    async def add_project(self, wid, project_name, is_private=False,
+                          active=True):
+        """ Coroutine version of Toggl.add_project() """
+        existing_projects = set(p['name'] for p in
+                                await self.get_projects(wid))
+        if project_name not in existing_projects:
+            params = {
+                'wid': wid,
+                'is_private': is_private,
+                'active': active,
+                'name': project_name
+            }
+            return await self._request(
+                '/api/v9/workspaces/%s/projects' % wid,
+                method='POST', body=json.dumps(params))
+
+    async def iter_detailed_report(self, wid, since, until, fields=None):
+        """ Async generator version of Toggl.iter_detailed_report() """
+        def records(report_page):
+            if fields is None:
+                return report_page['data']
+            return ({f: r.get(f) for f in fields} for r in report_page['data'])
+
+        report_page = await self._detailed_report_page(wid, since, until, 1)
+        per_page = report_page['per_page']
+        pages = (report_page['total_count'] + per_page - 1) // per_page
+        for record in records(report_page):
+            yield record
+
+        for batch in range(2, pages + 1, self.page_workers):
+            batch_pages = range(batch,
+                                min(batch + self.page_workers, pages + 1))
+            for report_page in await asyncio.gather(*[
+                    self._detailed_report_page(wid, since, until, page)
+                    for page in batch_pages]):
+                for record in records(report_page):
+                    yield record
+
+    async def detailed_report_count(self, wid, since, until):
+        """ Coroutine version of Toggl.detailed_report_count() """
+        return (await self._detailed_report_page(wid, since, until,
+                                                 1))['total_count']
+
+    async def detailed_report(self, wid, since, until):
+        """ Coroutine version of Toggl.detailed_report() """
+        return [record async for record in
+                self.iter_detailed_report(wid, since, until)]
+
+    async def sync_projects(self, wid, desired_projects, archive=False):
+        """ Coroutine version of Toggl.sync_projects() """
+        self._invalidate('workspace:%s/projects' % wid)
+        existing = {p['name']: p for p in await self._request(
+            '/api/v8/workspaces/{0}/projects'.format(wid),
+            {'active': 'both'}) or []}
+
+        tasks = self._project_tasks(existing, desired_projects, archive)
+        semaphore = asyncio.Semaphore(self.bulk_workers)
+
+        async def apply(task):
+            async with semaphore:
+                return await self._apply_project_task(wid, task)
+
+        result = {'created': [], 'updated': [], 'archived': []}
+        for (action, _, _), project in zip(
+                tasks, await asyncio.gather(*map(apply, tasks))):
+            result[action].append(project)
+        return result
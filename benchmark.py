@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the report pipeline.
+
+Typical usage:
+    ./benchmark.py timestamps --rows 1000000
+    ./benchmark.py pipeline --workspaces 5 --weeks 12 --latency 0.05
+
+The pipeline benchmark runs against a local fake Toggl API with synthetic
+data, which can also be started alone to try clients against it, e.g.
+Toggl(api_token, base_url='http://127.0.0.1:8080'):
+    ./benchmark.py serve --port 8080
+"""
+
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+try:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+try:  # Unix only
+    import resource
+except ImportError:
+    resource = None
+
+import settings
+import individual_report
+from detailed_report import fetch_tasks, week_list
+from team_report import TeamReport
+from toggl import Toggl, MemoryCache, Metrics, RateLimiter
+
+
+def synthetic_detailed_report(path, rows, seed=0):
+    """ Write a synthetic detailed report CSV, ordered by start time """
+    rnd = random.Random(seed)
+    start = datetime.datetime(2017, 1, 2, 8)
+    users = ['user%d' % i for i in range(100)]
+    teams = ['team%d' % i for i in range(20)]
+    projects = ['project%d' % i for i in range(10)] + ['']
+    with open(path, 'w') as fh:
+        writer = csv.DictWriter(
+            fh, ['user', 'team', 'project', 'start', 'duration'])
+        writer.writeheader()
+        for _ in range(rows):
+            start += datetime.timedelta(seconds=rnd.randint(0, 120))
+            writer.writerow({
+                'user': rnd.choice(users),
+                'team': rnd.choice(teams),
+                'project': rnd.choice(projects),
+                'start': start.strftime(
+                    individual_report.detailed_report_date_format),
+                'duration': round(rnd.random() * 4, 2),
+            })
+
+
+def strptime_path(records):
+    """ Week bucketing and entry end as done with datetime.strptime """
+    date_format = individual_report.detailed_report_date_format
+    for record in records:
+        d = datetime.datetime.strptime(record['start'], date_format)
+        d -= datetime.timedelta(days=d.weekday())
+        d.strftime(settings.report_date_format)
+        duration = datetime.timedelta(hours=float(record['duration']),
+                                      minutes=-1)
+        end = datetime.datetime.strptime(record['start'], date_format) + \
+            duration
+        end.strftime(date_format)
+
+
+def fast_path(records):
+    """ Week bucketing and entry end as done by individual_report """
+    for record in records:
+        individual_report.week(record['start'])
+        duration = datetime.timedelta(hours=float(record['duration']),
+                                      minutes=-1)
+        (individual_report.parse_timestamp(record['start']) +
+         duration).replace(microsecond=0)
+
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+
+def bench_timestamps(args):
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        synthetic_detailed_report(path, args.rows)
+        with open(path) as fh:
+            records = list(csv.DictReader(fh))
+    finally:
+        os.remove(path)
+
+    for name, func in (('strptime', strptime_path), ('fast', fast_path)):
+        elapsed = timed(func, records)
+        print("%-10s %8.2f s %12.0f records/s" %
+              (name, elapsed, len(records) / elapsed))
+
+
+class FakeToggl(object):
+    """ Synthetic workspaces, users, projects and time entries, and Toggl API
+    responses over them
+
+    Data is generated deterministically week by week, so reports over any
+    date range are consistent with each other.
+    """
+    per_page = 50
+    first_id = 1000
+
+    def __init__(self, workspaces=3, users=10, projects=5, entries=20,
+                 latency=0, rate_limited=0, retry_after=0, seed=0):
+        """
+        :param workspaces: number of workspaces
+        :param users: number of users per workspace, the last one is inactive
+        :param projects: number of projects per workspace
+        :param entries: number of time entries per user and week
+        :param latency: seconds added to every response
+        :param rate_limited: fraction of requests answered with status 429
+        :param retry_after: Retry-After of 429 responses, seconds
+        """
+        self.workspaces = workspaces
+        self.users = users
+        self.projects = projects
+        self.entries = entries
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._weeks = {}  # (wid, monday): list of time entries
+        self._lock = threading.Lock()
+
+    def get_workspaces(self):
+        return [{'id': wid, 'name': 'team%d' % wid, 'admin': True,
+                 'at': '2017-01-01T00:00:00+00:00'}
+                for wid in range(self.first_id,
+                                 self.first_id + self.workspaces)]
+
+    def get_workspace_users(self, wid):
+        return [{'id': wid * 1000 + i, 'uid': wid * 1000 + i,
+                 'name': 'user%d-%d' % (wid, i),
+                 'active': i < self.users - 1,
+                 'inactive': i == self.users - 1,
+                 'at': '2017-01-01T00:00:00+00:00'}
+                for i in range(self.users)]
+
+    def get_projects(self, wid):
+        return [{'id': wid * 1000 + i, 'wid': wid,
+                 'name': 'project%d-%d' % (wid, i), 'active': True,
+                 'at': '2017-01-01T00:00:00+00:00'}
+                for i in range(self.projects)]
+
+    def week_entries(self, wid, monday):
+        """ Time entries of a workspace for the week, ordered by start """
+        key = (wid, monday)
+        with self._lock:
+            if key in self._weeks:
+                return self._weeks[key]
+        rnd = random.Random('%s-%s-%s' % (self.seed, wid, monday))
+        projects = self.get_projects(wid) + [{'id': None, 'name': None}]
+        week_start = datetime.datetime.combine(monday, datetime.time())
+        entries = []
+        for user in self.get_workspace_users(wid):
+            for _ in range(self.entries):
+                start = week_start + datetime.timedelta(
+                    seconds=rnd.randrange(7 * 86400))
+                dur = rnd.randint(300, 4 * 3600)
+                end = start + datetime.timedelta(seconds=dur)
+                project = rnd.choice(projects)
+                entries.append({
+                    'id': rnd.getrandbits(48),
+                    'pid': project['id'],
+                    'uid': user['uid'],
+                    'user': user['name'],
+                    'project': project['name'],
+                    'description': '',
+                    'start': start.isoformat() + '+00:00',
+                    'end': end.isoformat() + '+00:00',
+                    'updated': end.isoformat() + '+00:00',
+                    'dur': dur * 1000,
+                    'tags': [],
+                })
+        entries.sort(key=lambda entry: entry['start'])
+        with self._lock:
+            self._weeks[key] = entries
+        return entries
+
+    def time_entries(self, wid, since, until):
+        """ Time entries started between two dates, inclusive """
+        since, until = since.isoformat(), until.isoformat()
+        monday = datetime.datetime.strptime(since, '%Y-%m-%d').date()
+        monday -= datetime.timedelta(days=monday.weekday())
+        entries = []
+        while monday.isoformat() <= until:
+            entries.extend(e for e in self.week_entries(wid, monday)
+                           if since <= e['start'][:10] <= until)
+            monday += datetime.timedelta(days=7)
+        return entries
+
+    def detailed_report(self, wid, since, until, page=1):
+        entries = self.time_entries(wid, since, until)
+        return {
+            'total_count': len(entries),
+            'per_page': self.per_page,
+            'total_grand': sum(e['dur'] for e in entries),
+            'data': entries[(page - 1) * self.per_page:page * self.per_page],
+        }
+
+    def weekly_report(self, wid, since):
+        """ Weekly report grouped by projects and then users, durations are
+        in milliseconds, null for days without entries """
+        until = since + datetime.timedelta(days=6)
+        projects = {}  # (pid, project): {(uid, user): [7 day totals]}
+        for entry in self.time_entries(wid, since, until):
+            day = (datetime.datetime.strptime(entry['start'][:10], '%Y-%m-%d')
+                   .date() - since).days
+            users = projects.setdefault((entry['pid'], entry['project']), {})
+            users.setdefault((entry['uid'], entry['user']),
+                             [0] * 7)[day] += entry['dur']
+
+        def totals(days):
+            return [d or None for d in days] + [sum(days) or None]
+
+        data = []
+        week_totals = [0] * 7
+        for (pid, project), users in sorted(projects.items(),
+                                            key=lambda i: i[0][1] or ''):
+            project_days = [sum(d) for d in zip(*users.values())]
+            week_totals = [a + b for a, b in zip(week_totals, project_days)]
+            data.append({
+                'pid': pid,
+                'title': {'project': project, 'client': None},
+                'totals': totals(project_days),
+                'details': [{'uid': uid, 'title': {'user': user},
+                             'totals': totals(days)}
+                            for (uid, user), days in sorted(users.items())],
+            })
+        return {'data': data, 'week_totals': totals(week_totals),
+                'total_grand': sum(week_totals) or None}
+
+    def respond(self, path, query):
+        """ Response to an API request
+        :param path: url path, e.g. /api/v8/workspaces
+        :param query: dict of query string params, as parsed by parse_qs
+        :return: (status, JSON-serializable body or None)
+        """
+        if self.rate_limited and self._random.random() < self.rate_limited:
+            return 429, None
+
+        def date(name):
+            return datetime.datetime.strptime(query[name][0],
+                                              '%Y-%m-%d').date()
+
+        parts = path.strip('/').split('/')
+        if path == '/api/v8/workspaces':
+            return 200, self.get_workspaces()
+        if parts[:3] == ['api', 'v8', 'workspaces'] and len(parts) == 5:
+            wid = int(parts[3])
+            if parts[4] == 'workspace_users':
+                return 200, self.get_workspace_users(wid)
+            if parts[4] == 'projects':
+                return 200, self.get_projects(wid)
+        if path == '/reports/api/v2/details':
+            return 200, self.detailed_report(
+                int(query['workspace_id'][0]), date('since'), date('until'),
+                int(query.get('page', ['1'])[0]))
+        if path == '/reports/api/v2/weekly':
+            return 200, self.weekly_report(int(query['workspace_id'][0]),
+                                           date('since'))
+        return 404, None
+
+
+class FakeTogglHandler(BaseHTTPRequestHandler):
+    """ Serves FakeToggl responses with keep-alive and gzip """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't hold the body back
+    disable_nagle_algorithm = True
+    fake = None  # FakeToggl instance
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        status, body = self.fake.respond(path, parse_qs(query))
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        data = b'' if body is None else json.dumps(body).encode('utf8')
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', str(self.fake.retry_after))
+        if data and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fh:
+                fh.write(data)
+            data = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeTogglServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(options, port=0, ready=None):
+    """ Serve a FakeToggl created with the options until interrupted
+    :param ready: optional queue to put the port number to once listening
+    """
+    handler = type('Handler', (FakeTogglHandler,),
+                   {'fake': FakeToggl(**options)})
+    server = FakeTogglServer(('127.0.0.1', port), handler)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(options):
+    """ Start a FakeToggl server in a child process, so it doesn't compete
+    with the benchmark for the GIL or add to its memory use
+    :return: (process, base url of the API)
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(options, 0, ready))
+    process.daemon = True
+    process.start()
+    return process, 'http://127.0.0.1:%d' % ready.get()
+
+
+def fake_options(args):
+    return {
+        'workspaces': args.workspaces,
+        'users': args.users,
+        'projects': args.projects,
+        'entries': args.entries,
+        'latency': args.latency,
+        'rate_limited': args.rate_limited,
+        'seed': args.seed,
+    }
+
+
+def peak_rss():
+    """ Peak resident set size of the process in MB, None if unknown """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1048576.0 if os.uname()[0] == 'Darwin' else 1024.0)
+
+
+def bench_pipeline(args):
+    """ Time fetching detailed reports from a fake Toggl API and building
+    individual and team reports out of them, as report.py does """
+    process, base_url = start_server(fake_options(args))
+    try:
+        metrics = Metrics()
+        toggl = Toggl('benchmark', cache=MemoryCache(max_entries=100),
+                      rate_limiter=RateLimiter(args.rate, 1),
+                      base_url=base_url, metrics=metrics)
+        start = datetime.datetime(2017, 1, 2)
+        weeks = week_list(start, start + datetime.timedelta(weeks=args.weeks))
+        started = time.time()
+        workspaces = [(w['name'], w['id'])
+                      for w in toggl.metadata.workspaces().values()]
+        tasks = [(workspace, monday, sunday)
+                 for (monday, sunday) in weeks for workspace in workspaces]
+        counter = [0]
+
+        def records():
+            for _, rows in fetch_tasks(toggl, tasks, workers=args.workers):
+                for row in rows:
+                    counter[0] += 1
+                    yield row
+
+        with open(os.devnull, 'w') as devnull:
+            err_writer = csv.DictWriter(
+                devnull, individual_report.violations_fieldnames)
+            week_names, individual_rows = individual_report.engines[
+                args.engine](records(), err_writer, args.threshold)
+            team = TeamReport(week_names)
+            for row in individual_rows:
+                team.add(row)
+            list(team.rows())
+        elapsed = time.time() - started
+    finally:
+        process.terminate()
+
+    rss = peak_rss()
+    print("pipeline   %8.2f s %12.0f records/s %8d records %s" %
+          (elapsed, counter[0] / elapsed, counter[0],
+           '' if rss is None else '%8.1f MB peak RSS' % rss))
+    if args.stats:
+        print(metrics.summary())
+
+
+def serve_forever(args):
+    print("Serving fake Toggl API at http://127.0.0.1:%d" % args.port)
+    try:
+        serve(fake_options(args), args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the report pipeline")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    timestamps = subparsers.add_parser(
+        'timestamps', help="timestamp parsing and week bucketing of "
+                           "individual_report.py")
+    timestamps.add_argument('-n', '--rows', type=int, default=1000000,
+                            help="number of synthetic records, default: 1M")
+    timestamps.set_defaults(func=bench_timestamps)
+
+    def add_fake_arguments(subparser):
+        subparser.add_argument('--workspaces', type=int, default=3,
+                               help="number of workspaces, default: 3")
+        subparser.add_argument('--users', type=int, default=10,
+                               help="users per workspace, default: 10")
+        subparser.add_argument('--projects', type=int, default=5,
+                               help="projects per workspace, default: 5")
+        subparser.add_argument('--entries', type=int, default=20,
+                               help="time entries per user and week, "
+                                    "default: 20")
+        subparser.add_argument('--latency', type=float, default=0,
+                               help="seconds added to every response")
+        subparser.add_argument('--rate-limited', type=float, default=0,
+                               help="fraction of requests answered with "
+                                    "status 429, e.g. 0.05")
+        subparser.add_argument('--seed', type=int, default=0)
+
+    pipeline = subparsers.add_parser(
+        'pipeline', help="fetch, individual and team report stages against "
+                         "a local fake Toggl API")
+    add_fake_arguments(pipeline)
+    pipeline.add_argument('--weeks', type=int, default=12,
+                          help="number of weeks, default: 12")
+    pipeline.add_argument('-w', '--workers', type=int, default=1,
+                          help="workspaces fetched concurrently, "
+                               "default: 1")
+    pipeline.add_argument('--rate', type=float, default=1000,
+                          help="client rate limit, requests per second, "
+                               "default: 1000 (Toggl allows 1)")
+    pipeline.add_argument('-e', '--engine', default='python',
+                          choices=sorted(individual_report.engines))
+    pipeline.add_argument('-n', '--threshold', type=int, default=10)
+    pipeline.add_argument('--stats', action='store_true',
+                          help="print API request statistics")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    fake = subparsers.add_parser('serve', help="run the fake Toggl API")
+    add_fake_arguments(fake)
+    fake.add_argument('-p', '--port', type=int, default=8080)
+    fake.set_defaults(func=serve_forever)
+    args = parser.parse_args()
+
+    if not hasattr(args, 'func'):
+        parser.exit(1, parser.format_help())
+    args.func(args)
@@ -0,0 +1,234 @@
+"""
+Compact binary columnar format for intermediate reports
+
+A file is a struct-of-arrays: a JSON header describing columns followed by
+one little-endian array per column. String columns are stored as uint32
+indexes into a table of unique values, timestamps as fixed width ASCII
+(%Y-%m-%dT%H:%M:%S, 19 bytes) and everything else as float64. Regular files
+are memory-mapped on read, so there is no text parsing involved.
+
+Reader and writer mimic csv.DictReader and csv.DictWriter. Use open_reader()
+to read either format (detected by the file signature) and open_writer() to
+write the format of choice:
+
+    writer = open_writer(sys.stdout, ['user', 'duration'], 'columnar')
+    writer.writeheader()
+    writer.writerow({'user': 'john', 'duration': 1.5})
+    writer.close()
+"""
+
+import array
+import csv
+import json
+import mmap
+import os
+import stat
+import struct
+import sys
+
+MAGIC = b'TGLCOL1\n'
+FORMATS = ('csv', 'columnar')
+# array typecodes by column type
+_typecodes = {'str': 'I', 'float': 'd', 'timestamp': 'B'}
+timestamp_size = 19  # e.g. 2015-05-29T16:07:20
+# columns of report files which are not numbers
+string_columns = ('user', 'team', 'project', 'rule', 'date')
+# number of rows decoded at once while iterating a file
+chunk_size = 65536
+
+
+def column_types(fieldnames):
+    """ Guess column types of a report by the column names """
+    return [('str' if name in string_columns else
+             'timestamp' if name == 'start' else
+             'float') for name in fieldnames]
+
+
+def _binary(fileobj):
+    """ Underlying binary stream of a text file, e.g. sys.stdout """
+    return getattr(fileobj, 'buffer', fileobj)
+
+
+class ColumnarWriter(object):
+    """ Write dicts to a columnar file, similar to csv.DictWriter
+
+    Columns are accumulated in memory and the file is written on close()
+    """
+
+    def __init__(self, fileobj, fieldnames, types=None):
+        """
+        :param fileobj: file object to write to, text or binary
+        :param fieldnames: list of column names
+        :param types: list of column types, 'str', 'float' or 'timestamp'.
+            By default guessed by column_types()
+        """
+        self.fileobj = fileobj
+        self.fieldnames = list(fieldnames)
+        self.types = types or column_types(self.fieldnames)
+        # columns with duplicate names hold the same values
+        self._names = []
+        for name, column_type in zip(self.fieldnames, self.types):
+            if name not in [n for n, _ in self._names]:
+                self._names.append((name, column_type))
+        self._columns = [array.array(_typecodes[t]) for _, t in self._names]
+        self._strings = [{} for _ in self._names]
+
+    def writeheader(self):
+        """ Header is written on close(), this is for compatibility """
+        pass
+
+    def writerow(self, row):
+        for (name, column_type), column, strings in zip(
+                self._names, self._columns, self._strings):
+            value = row.get(name)
+            if column_type == 'str':
+                value = '' if value is None else value
+                index = strings.get(value)
+                if index is None:
+                    index = strings[value] = len(strings)
+                column.append(index)
+            elif column_type == 'timestamp':
+                column.frombytes(value[:timestamp_size].encode('ascii'))
+            else:
+                column.append(float(value or 0))
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        rows = 0
+        if self._columns:
+            rows = len(self._columns[0])
+            if self._names[0][1] == 'timestamp':
+                rows //= timestamp_size
+        header = {'fieldnames': self.fieldnames, 'rows': rows, 'columns': []}
+        offset = 0
+        for (name, column_type), column, strings in zip(
+                self._names, self._columns, self._strings):
+            size = len(column) * column.itemsize
+            header['columns'].append({
+                'name': name,
+                'type': column_type,
+                'offset': offset,
+                'size': size,
+                'strings': sorted(strings, key=strings.get)
+                if column_type == 'str' else None,
+            })
+            offset += size + (-size % 8)  # keep arrays 8-byte aligned
+
+        header_bytes = json.dumps(header).encode('utf8')
+        header_bytes += b' ' * (-(len(header_bytes) + 16) % 8)
+        out = _binary(self.fileobj)
+        out.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for column in self._columns:
+            if sys.byteorder == 'big':
+                column.byteswap()
+            data = column.tobytes()
+            out.write(data + b'\0' * (-len(data) % 8))
+        out.flush()
+
+
+class ColumnarReader(object):
+    """ Read a columnar file as dicts, similar to csv.DictReader
+
+    Individual columns are also available as lists via column()
+    """
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: file object to read from, text or binary. Regular
+            files are memory-mapped, other streams are read into memory
+        """
+        stream = _binary(fileobj)
+        self._buffer = None
+        try:
+            if stat.S_ISREG(os.fstat(stream.fileno()).st_mode):
+                self._buffer = mmap.mmap(stream.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        if self._buffer is None:
+            self._buffer = stream.read()
+
+        if self._buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a columnar report file")
+        header_size, = struct.unpack(
+            '<Q', self._buffer[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8
+        header = json.loads(
+            self._buffer[start:start + header_size].decode('utf8'))
+        self._data_offset = start + header_size
+        self.fieldnames = header['fieldnames']
+        self.rows = header['rows']
+        self._columns = {c['name']: c for c in header['columns']}
+
+    def _values(self, name, start=0, stop=None):
+        """ Decode rows [start, stop) of a column """
+        column = self._columns[name]
+        stop = self.rows if stop is None else min(stop, self.rows)
+        typecode = _typecodes[column['type']]
+        itemsize = array.array(typecode).itemsize
+        if column['type'] == 'timestamp':
+            itemsize = timestamp_size
+        offset = self._data_offset + column['offset']
+        data = memoryview(self._buffer)[offset + start * itemsize:
+                                        offset + stop * itemsize]
+        if column['type'] == 'timestamp':
+            text = data.tobytes().decode('ascii')
+            return [text[i:i + timestamp_size]
+                    for i in range(0, len(text), timestamp_size)]
+        if sys.byteorder == 'big':
+            values = array.array(typecode, data.tobytes())
+            values.byteswap()
+            values = values.tolist()
+        else:
+            values = data.cast(typecode).tolist()
+
+        if column['type'] == 'str':
+            strings = column['strings']
+            return [strings[i] for i in values]
+        return values
+
+    def column(self, name):
+        """ All values of a column as a list """
+        return self._values(name)
+
+    def __iter__(self):
+        names = list(self._columns)
+        for start in range(0, self.rows, chunk_size):
+            columns = [self._values(name, start, start + chunk_size)
+                       for name in names]
+            for values in zip(*columns):
+                yield dict(zip(names, values))
+
+
+class CSVWriter(csv.DictWriter):
+    """ csv.DictWriter with close(), to be interchangeable with
+    ColumnarWriter
+    """
+
+    def close(self):
+        pass
+
+
+def open_reader(fileobj):
+    """ Get dict reader for a report file in any supported format """
+    stream = _binary(fileobj)
+    try:
+        columnar = stream.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    except AttributeError:
+        columnar = False
+    if columnar:
+        return ColumnarReader(fileobj)
+    return csv.DictReader(fileobj)
+
+
+def open_writer(fileobj, fieldnames, format='csv'):
+    """ Get dict writer of the report file in the specified format
+    :param format: one of FORMATS
+    :return: writer with writeheader(), writerow(), writerows() and close()
+    """
+    if format == 'columnar':
+        return ColumnarWriter(fileobj, fieldnames)
+    return CSVWriter(fileobj, fieldnames)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""
+Long-running report builder with a built-in web server
+
+Instead of a cron chain of scripts, one process keeps a Toggl client, its
+metadata and detailed report rows of closed weeks in memory. Every
+`interval` seconds it refreshes the metadata, fetches only the weeks which
+were still open at the time of the previous fetch (and new ones), and
+rebuilds individual, violations and team reports plus the dashboard data.
+Files in the output directory are replaced atomically and served over HTTP
+together with team.html and details.html:
+
+    ./daemon.py --output www --port 8000 --interval 300
+
+Request statistics are available at /metrics in Prometheus text format.
+"""
+
+import argparse
+import csv
+import datetime
+import logging
+import os
+import shutil
+import threading
+import time
+
+try:  # Python 3
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from importlib import reload
+    from io import StringIO
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from StringIO import StringIO
+
+import settings
+from dashboard import DashboardData, write_file
+from detailed_report import fetch_tasks, week_list
+from individual_report import engines, violations_fieldnames
+from team_report import team_report
+from toggl import Toggl, MemoryCache, Metrics, SQLiteCache
+
+# pages served along with the reports, from the directory of this script
+pages = ('team.html', 'details.html')
+
+
+def _encode(text):
+    """ UTF-8 bytes of the text, str is already bytes in Python 2 """
+    return text if isinstance(text, bytes) else text.encode('utf8')
+
+
+def csv_content(fieldnames, rows):
+    """ CSV file content of the rows, as bytes """
+    output = StringIO()
+    writer = csv.DictWriter(output, fieldnames)
+    writer.writeheader()
+    writer.writerows(rows)
+    return _encode(output.getvalue())
+
+
+class ReportDaemon(object):
+    """ Reports of a Toggl client, kept up to date by refresh()
+
+    Example:
+        daemon = ReportDaemon(toggl, 'www')
+        while True:
+            daemon.refresh()
+            time.sleep(300)
+    """
+
+    def __init__(self, toggl, output, include_inactive=False, workers=1,
+                 threshold=10, engine='python', current_week=False):
+        """
+        :param toggl: Toggl instance, kept for the lifetime of the daemon
+        :param output: directory to save reports and dashboard data to
+        :param include_inactive: include records of disabled users
+        :param workers: number of workspaces fetched concurrently
+        :param threshold: time record threshold in hours
+        :param engine: aggregation engine of the individual report
+        :param current_week: also report the week in progress
+        """
+        self.toggl = toggl
+        self.output = output
+        self.include_inactive = include_inactive
+        self.workers = workers
+        self.threshold = threshold
+        self.engine = engine
+        self.current_week = current_week
+        self.updated = None  # time of the last refresh
+        self._rows = {}  # (ws_id, monday): detailed report rows
+        self._closed = set()  # keys of weeks fetched after they were over
+        self._lock = threading.Lock()
+
+    def weeks(self, today):
+        """ Reported weeks, as (monday, sunday) tuples """
+        if not self.current_week:
+            return week_list(settings.start_date, today)
+        return [(monday, sunday) for (monday, sunday) in week_list(
+            settings.start_date, today + datetime.timedelta(days=7))
+            if monday <= today]
+
+    def refresh(self, today=None):
+        """ Fetch changes and rebuild reports
+        :return: number of (workspace, week) reports fetched
+        """
+        with self._lock:
+            today = today or datetime.datetime.now()
+            if self.updated is not None and \
+                    self.updated.date() != today.date():
+                reload(settings)  # e.g. automatic dates of a new period
+            # names in detailed report records and the set of disabled users
+            # could change, so closed weeks of these workspaces can't be
+            # reused anymore, neither kept nor cached by the client
+            changed = self.toggl.metadata.refresh()
+            if changed:
+                logging.info("Workspaces, users or projects of %d workspaces "
+                             "have changed, fetching their weeks again",
+                             len(changed))
+                self.toggl._invalidate(*['workspace:%s/reports' % wid
+                                         for wid in changed])
+                for key in [key for key in self._rows if key[0] in changed]:
+                    del self._rows[key]
+                    self._closed.discard(key)
+
+            workspaces = [(w['name'], w['id']) for w in
+                          self.toggl.metadata.workspaces().values()]
+            for (_, ws_id) in workspaces:  # so the next refresh checks them
+                self.toggl.metadata.users(ws_id)
+                self.toggl.metadata.projects(ws_id)
+            weeks = self.weeks(today)
+            keys = set((ws_id, monday) for (monday, _) in weeks
+                       for (_, ws_id) in workspaces)
+            for key in set(self._rows) - keys:
+                del self._rows[key]
+                self._closed.discard(key)
+
+            tasks = [(workspace, monday, sunday)
+                     for (monday, sunday) in weeks
+                     for workspace in workspaces
+                     if (workspace[1], monday) not in self._closed]
+            for (workspace, monday, sunday), rows in fetch_tasks(
+                    self.toggl, tasks, self.include_inactive, self.workers):
+                self._rows[(workspace[1], monday)] = rows
+                if sunday.date() < today.date():
+                    self._closed.add((workspace[1], monday))
+
+            self.write([row for (monday, _) in weeks
+                        for (_, ws_id) in workspaces
+                        for row in self._rows.get((ws_id, monday), ())])
+            self.updated = today
+            logging.info("Reports are updated, %d weeks fetched", len(tasks))
+            return len(tasks)
+
+    def write(self, records):
+        """ Build reports from detailed report records and save them """
+        violations = StringIO()
+        err_writer = csv.DictWriter(violations, violations_fieldnames)
+        err_writer.writeheader()
+        # engines can modify records, which are kept for the next refresh
+        week_names, individual_rows = engines[self.engine](
+            (dict(record) for record in records), err_writer, self.threshold)
+        individual_rows = list(individual_rows)
+        team_rows = team_report(individual_rows, week_names)
+
+        dashboard = DashboardData(os.path.join(self.output, 'data'))
+        for record in records:
+            dashboard.add_entry(record)
+        dashboard.set_team_report(week_names, team_rows)
+        dashboard.close()
+
+        write_file(os.path.join(self.output, 'violations.csv'),
+                   _encode(violations.getvalue()))
+        write_file(os.path.join(self.output, 'individual.csv'), csv_content(
+            ['user', 'team', 'project', 'average'] + week_names,
+            individual_rows))
+        write_file(os.path.join(self.output, 'team.csv'), csv_content(
+            ['team', 'project', 'average', 'std'] + week_names, team_rows))
+
+
+class ReportHandler(SimpleHTTPRequestHandler):
+    """ Serves files of the output directory and /metrics """
+    root = '.'  # output directory
+    metrics = None  # Metrics instance
+
+    def translate_path(self, path):
+        path = SimpleHTTPRequestHandler.translate_path(self, path)
+        return os.path.join(self.root, os.path.relpath(path, os.getcwd()))
+
+    def do_GET(self):
+        if self.path != '/metrics' or self.metrics is None:
+            return SimpleHTTPRequestHandler.do_GET(self)
+        data = self.metrics.prometheus().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+
+class ReportServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Keep individual and team reports up to date and serve "
+                    "them over HTTP along with team.html and details.html.\n"
+                    "Typical usage:\n"
+                    "./daemon.py --output www --port 8000")
+    parser.add_argument('-o', '--output', default='www',
+                        help='Directory to save reports to, default: www')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to serve reports at, default: '
+                             '127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='Port to serve reports at, 0 to not serve them, '
+                             'default: 8000')
+    parser.add_argument('-i', '--interval', type=float, default=300,
+                        help='Seconds between refreshes, default: 300')
+    parser.add_argument('--current-week', action='store_true',
+                        help="Also report the week in progress")
+    parser.add_argument('-n', '--threshold', type=int, default=10,
+                        help='time record threshold in hours')
+    parser.add_argument('-e', '--engine', default='python',
+                        choices=sorted(engines),
+                        help='aggregation engine of the individual report, '
+                             'default: python')
+    parser.add_argument('-v', '--verbose',  default=3,
+                        help="Verboseness, 5: debug, 1: quiet, default: 3")
+    parser.add_argument('-a', '--all', action='store_true',
+                        help="Include records from disabled users (omitted by "
+                             "default)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of workspaces fetched concurrently,"
+                             " default: 1")
+    parser.add_argument('-c', '--cache',
+                        help="Path to a persistent response cache (SQLite). "
+                             "Reports on closed weeks are reused across "
+                             "restarts")
+    args = parser.parse_args()
+
+    try:  # verboseness
+        verboseness = max(1, 5 - int(args.verbose) * 1) * 10
+    except ValueError:
+        verboseness = 30
+    logging.basicConfig(level=verboseness)
+
+    if datetime.datetime.now() < settings.start_date:
+        parser.exit(1, "Start date ({0}) has not yet come.\n Check dates in"
+                       "the settings.py\n".format(settings.start_date))
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for page in pages:
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 page), args.output)
+
+    metrics = Metrics()
+    toggl = Toggl(settings.api_token, cache=SQLiteCache(args.cache)
+                  if args.cache else MemoryCache(max_entries=100),
+                  metrics=metrics)
+    daemon = ReportDaemon(toggl, args.output, args.all, args.workers,
+                          args.threshold, args.engine, args.current_week)
+
+    if args.port:
+        handler = type('Handler', (ReportHandler,),
+                       {'root': os.path.abspath(args.output),
+                        'metrics': metrics})
+        server = ReportServer((args.host, args.port), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.warning("Serving reports at http://%s:%d/team.html",
+                        *server.server_address[:2])
+
+    try:
+        while True:
+            started = time.time()
+            try:
+                daemon.refresh()
+            except Exception:
+                logging.exception("Failed to refresh reports")
+            time.sleep(max(0, args.interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        toggl.close()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+Pre-aggregated JSON data of team.html and details.html
+
+Instead of parsing whole CSV reports in the browser, the pages load a small
+index and then only the shards they display:
+
+    data/index.json                    weeks, teams, their users and shards
+    data/teams/<team>.json             team report rows of a team
+    data/details/<team>/<monday>.json  time entries of a team in a week
+
+Shards are compact JSON with sorted keys (compresses well if the web server
+gzips responses). Unchanged shards are not rewritten, the rest are replaced
+atomically, and the index is written last.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+from collections import OrderedDict
+
+from columnar import open_reader
+
+date_format = '%Y-%m-%d'
+# os.rename() doesn't replace existing files on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+def write_file(path, content):
+    """ Replace the file atomically, unless it already has the same content
+    :param content: bytes
+    :return: True if the file was written
+    """
+    try:
+        with open(path, 'rb') as fh:
+            if fh.read() == content:
+                return False
+    except (IOError, OSError):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(content)
+    _replace(tmp_path, path)
+    return True
+
+
+def _monday(start):
+    """ Monday of the week of the detailed report timestamp, YYYY-MM-DD """
+    d = datetime.date(int(start[:4]), int(start[5:7]), int(start[8:10]))
+    return (d - datetime.timedelta(days=d.weekday())).strftime(date_format)
+
+
+class DashboardData(object):
+    """ Writer of the sharded dashboard data
+
+    Example:
+        data = DashboardData('data')
+        for record in detailed_report_records:
+            data.add_entry(record)
+        data.set_team_report(week_names, team_report_rows)
+        data.close()
+
+    Detailed report records are expected in week order, as they are produced
+    by all report scripts. Entries of a week are written as soon as the next
+    week starts, so memory doesn't grow with the length of the history.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0  # number of shards actually (re)written
+        self._teams = OrderedDict()  # name: index entry
+        self._slugs = set()
+        self._week = None  # monday of the buffered entries
+        self._entries = OrderedDict()  # team: {user: [[project, start, h]]}
+        self._week_names = []
+        self._team_rows = OrderedDict()  # team: [[project, avg, std] + weeks]
+
+    def _team(self, name):
+        """ Index entry of a team, created on first use """
+        team = self._teams.get(name)
+        if team is None:
+            slug = re.sub(r'[^\w-]+', '-', name.lower()).strip('-') or 'team'
+            unique, i = slug, 1
+            while unique in self._slugs:
+                i += 1
+                unique = '%s-%d' % (slug, i)
+            self._slugs.add(unique)
+            team = self._teams[name] = {
+                'name': name,
+                'report': 'teams/%s.json' % unique,
+                'details': 'details/%s/' % unique,
+                'users': set(),
+                'weeks': [],
+            }
+        return team
+
+    def _write(self, name, data):
+        """ Save a shard, unless it already has the same content """
+        content = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        if write_file(os.path.join(self.path, *name.split('/')),
+                      content.encode('utf8')):
+            self.written += 1
+
+    def _flush(self):
+        for name, users in self._entries.items():
+            team = self._team(name)
+            if self._week not in team['weeks']:
+                team['weeks'].append(self._week)
+            self._write(team['details'] + self._week + '.json', users)
+        self._entries = OrderedDict()
+
+    def add_entry(self, record):
+        """ Add a detailed report record, i.e. a dict with keys
+        user, team, project, start and duration
+        """
+        week = _monday(record['start'])
+        if week != self._week:
+            self._flush()
+            self._week = week
+        team = self._team(record['team'])
+        team['users'].add(record['user'])
+        self._entries.setdefault(record['team'], OrderedDict()).setdefault(
+            record['user'], []).append(
+            [record['project'] or '', record['start'],
+             float(record['duration'])])
+
+    writerow = add_entry  # so it can be used as a report writer
+
+    def set_team_report(self, week_names, rows):
+        """
+        :param week_names: list of week names, in the order of report columns
+        :param rows: team report rows, dicts with keys
+            ['team', 'project', 'average', 'std'] + week_names
+        """
+        self._week_names = list(week_names)
+        self._team_rows = OrderedDict()
+        for row in rows:
+            self._team(row['team'])
+            self._team_rows.setdefault(row['team'], []).append(
+                [row['project'], float(row['average']), float(row['std'])] +
+                [float(row[week_name]) for week_name in week_names])
+
+    def close(self):
+        """ Write the remaining shards and the index """
+        self._flush()
+        for name, rows in self._team_rows.items():
+            rows.sort(key=lambda row: row[0])
+            self._write(self._teams[name]['report'], {'rows': rows})
+
+        teams = []
+        for name, team in self._teams.items():
+            team = dict(team, users=sorted(team['users']))
+            if name not in self._team_rows:
+                team['report'] = None
+            teams.append(team)
+        weeks = sorted(set(w for team in teams for w in team['weeks']))
+        self._write('index.json', {
+            'weeks': self._week_names,
+            'last_week': weeks[-1] if weeks else None,
+            'teams': teams,
+        })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert detailed and/or team reports to sharded JSON "
+                    "data of details.html and team.html.\n"
+                    "Typical usage:\n"
+                    "./dashboard.py --detailed detailed.csv --team team.csv "
+                    "-o data")
+    parser.add_argument('--detailed', type=argparse.FileType('r'),
+                        help='Detailed report, used by details.html')
+    parser.add_argument('--team', type=argparse.FileType('r'),
+                        help='Team report, used by team.html')
+    parser.add_argument('-o', '--output', default='data',
+                        help='Output directory, default: data')
+    args = parser.parse_args()
+
+    if not args.detailed and not args.team:
+        parser.exit(1, "Nothing to convert, use --detailed and/or --team\n")
+
+    dashboard = DashboardData(args.output)
+    if args.detailed:
+        for record in open_reader(args.detailed):
+            dashboard.add_entry(record)
+    if args.team:
+        reader = open_reader(args.team)
+        dashboard.set_team_report(reader.fieldnames[4:], reader)
+    dashboard.close()
@@ -5,12 +5,27 @@ Export detailed report in CSV using Toggl API
 """
 
 import argparse
-import csv
 import datetime
+import hashlib
+import itertools
+import json
 import logging
+import sys
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import settings
-from toggl import Toggl
+from columnar import FORMATS, open_writer
+from store import TimeEntryStore
+from toggl import Toggl, MemoryCache, Metrics, SQLiteCache
+
+# Toggl reports API allows date ranges up to a year long
+max_range_weeks = 52
+# date ranges of busy workspaces are narrowed to about this many records
+range_records = 10000
+# fields of Toggl detailed report records used by reports
+report_fields = ['uid', 'user', 'project', 'start', 'dur']
 
 
 def week_list(s_date, e_date):
@@ -27,6 +42,278 @@ def week_list(s_date, e_date):
     return wl
 
 
+def report_rows(records, ws_name, inactive_users=()):
+    """ Convert Toggl detailed report records to detailed report rows
+    :param inactive_users: ids of users whose records are skipped
+    :return: generator of dicts with keys: user, team, project, start, duration
+    """
+    for record in records:
+        # exclude inactive users
+        if record['uid'] in inactive_users:
+            continue
+
+        # record duration is in milliseconds
+        # divide by 3600000 to convert to hours
+        yield {
+            'user': record['user'],
+            'team': ws_name,
+            'project': record['project'],
+            # example of record['start']: 2015-05-29T16:07:20+03:00
+            'start': record['start'][:19],
+            'duration': round(float(record['dur']) / 3600000, 2)
+        }
+
+
+def inactive_users(toggl, ws_id, include_inactive=False, store=None):
+    """ Ids of disabled users whose records are skipped
+    They are also saved to the store if there is one
+    """
+    if store is not None:
+        store.set_inactive_users(ws_id, toggl.metadata.inactive_users(ws_id))
+    if include_inactive:
+        return frozenset()
+    return toggl.metadata.inactive_users(ws_id)
+
+
+def _date(value):
+    """ Date of a date or datetime """
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def next_range(weeks, records_per_week=None, origin=None):
+    """ Leading weeks of the list to be fetched by one report
+
+    Closed weeks are fetched in blocks of 1, 2, 4, .. consecutive weeks,
+    aligned to a multiple of their length counted from the week of `origin`.
+    This way a block always covers the same dates and the report on it stays
+    cached across runs, even as the reported period grows. Blocks are at most
+    `max_range_weeks` long and, given the expected number of records per week,
+    narrowed to about `range_records` records. Weeks which are not over yet
+    go to a range of their own.
+    :param weeks: list of (monday, sunday) tuples, ascending
+    :param origin: first date blocks are counted from, settings.start_date
+        by default
+    :return: list of weeks
+    """
+    size = max_range_weeks
+    if records_per_week:
+        size = max(1, min(size, int(range_records // records_per_week)))
+    today = datetime.date.today()
+    chunk = []
+    for monday, sunday in weeks[:size]:
+        if chunk and (monday - chunk[-1][0]).days != 7:
+            break  # not consecutive
+        if _date(sunday) >= today:
+            return chunk or [(monday, sunday)]  # open week
+        chunk.append((monday, sunday))
+
+    origin = _date(origin or settings.start_date)
+    origin -= datetime.timedelta(days=origin.weekday())
+    week = (_date(chunk[0][0]) - origin).days // 7
+    length = 1
+    while length * 2 <= len(chunk) and week % (length * 2) == 0:
+        length *= 2
+    return chunk[:length]
+
+
+def iter_weeks(toggl, workspace, weeks, include_inactive=False, store=None):
+    """ Generate detailed report rows of a workspace for a list of weeks
+
+    Instead of one report per week, records are fetched for blocks of weeks
+    with fixed date ranges (see next_range()) and split into weeks locally.
+    Ranges are narrowed for busy workspaces, judging by the number of records
+    in the previous range or the first page of the report.
+    :param toggl: Toggl instance
+    :param workspace: (ws_name, ws_id) tuple
+    :param weeks: list of (monday, sunday) tuples, ascending
+    :param include_inactive: whether to keep records of disabled users
+    :param store: optional TimeEntryStore to save fetched entries to
+    :return: generator of ((monday, sunday), list of rows) for every week
+    """
+    ws_name, ws_id = workspace
+    skipped = inactive_users(toggl, ws_id, include_inactive, store)
+    fields = None if store is not None else report_fields
+    records_per_week = None
+    while weeks:
+        chunk = next_range(weeks, records_per_week)
+        since, until = chunk[0][0], chunk[-1][1]
+        if len(chunk) > 1:
+            # the first page is cached, so it's not fetched twice
+            count = toggl.detailed_report_count(ws_id, since, until)
+            records_per_week = float(count) / len(chunk)
+            if count > range_records:
+                continue  # narrow the range
+        records = toggl.iter_detailed_report(ws_id, since, until, fields)
+
+        days = {}  # YYYY-MM-DD: position of its week in the chunk
+        for i, (monday, _) in enumerate(chunk):
+            for day in range(7):
+                days[(monday + datetime.timedelta(days=day)).strftime(
+                    '%Y-%m-%d')] = i
+
+        def week_rows(i, week_records):
+            monday, sunday = chunk[i]
+            if store is not None:
+                store.replace_range(ws_id, ws_name, monday, sunday,
+                                    week_records)
+            return list(report_rows(week_records, ws_name, skipped))
+
+        # records are ordered by date, so a week is complete as soon as a
+        # record of a later one arrives and only one week is kept in memory
+        current, week_records, count = 0, [], 0
+        for record in itertools.chain(records, [None]):  # None: the end
+            i = len(chunk) if record is None else days[record['start'][:10]]
+            if i < current:
+                raise ValueError("Detailed report records are not ordered "
+                                 "by date")
+            while current < i:
+                rows = week_rows(current, week_records)
+                count += len(rows)
+                yield chunk[current], rows
+                current, week_records = current + 1, []
+            if record is not None:
+                week_records.append(record)
+
+        if len(chunk) > 1 or records_per_week is None:
+            records_per_week = float(count) / len(chunk)
+        weeks = weeks[len(chunk):]
+
+
+def _prefetch(pool, iterator):
+    """ Iterate in the pool, one item ahead of the consumer """
+    end = object()
+    pending = pool.apply_async(next, (iterator, end))
+    while True:
+        item = pending.get()
+        if item is end:
+            return
+        pending = pool.apply_async(next, (iterator, end))
+        yield item
+
+
+def fetch_tasks(toggl, tasks, include_inactive=False, workers=1, store=None):
+    """ Fetch detailed report rows for a list of weeks and workspaces
+
+    Weeks of every workspace are fetched in ranges, see iter_weeks()
+    :param tasks: list of (workspace, monday, sunday) tuples
+    :param workers: number of workspaces fetched concurrently
+    :param store: optional TimeEntryStore to save fetched entries to
+    :return: generator of (task, rows) in the order of tasks
+    """
+    workspaces = OrderedDict()  # ws_id: (workspace, list of weeks)
+    for workspace, monday, sunday in tasks:
+        workspaces.setdefault(workspace[1], (workspace, []))[1].append(
+            (monday, sunday))
+    streams = dict(
+        (ws_id, iter_weeks(toggl, workspace, sorted(weeks), include_inactive,
+                           store))
+        for ws_id, (workspace, weeks) in workspaces.items())
+
+    pool = None
+    if workers > 1:
+        pool = ThreadPool(workers)
+        streams = dict((ws_id, _prefetch(pool, stream))
+                       for ws_id, stream in streams.items())
+    try:
+        # weeks of every workspace come in order, so tasks are served in the
+        # same order as they were listed, whatever it is
+        pending = {}  # (ws_id, monday): rows of weeks fetched ahead
+        for task in tasks:
+            workspace, monday, _ = task
+            key = (workspace[1], monday)
+            while key not in pending:
+                week, rows = next(streams[workspace[1]])
+                pending[(workspace[1], week[0])] = rows
+            yield task, pending.pop(key)
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def sync_store(toggl, store, workspaces, weeks, workers=1):
+    """ Bring the store up to date for the weeks of workspaces
+
+    Changes are merged by Toggl.sync_changes(), the weeks it leaves are
+    fetched in ranges as by a regular run, see fetch_tasks()
+    :param store: TimeEntryStore instance
+    :param workspaces: list of (ws_name, ws_id) tuples
+    :param weeks: list of (monday, sunday) tuples, ascending
+    :param workers: number of workspaces fetched concurrently
+    :return: number of (workspace, week) reports fetched
+    """
+    started = time.time()
+    refetched = dict((ws_id, _date(toggl.sync_changes(
+        store, ws_id, ws_name, weeks[0][0]))) for ws_name, ws_id in workspaces)
+    tasks = [(workspace, monday, sunday)
+             for (monday, sunday) in weeks
+             for workspace in workspaces
+             if _date(sunday) >= refetched[workspace[1]]]
+    for _ in fetch_tasks(toggl, tasks, True, workers, store):
+        pass
+    for _, ws_id in workspaces:
+        store.set_synced_at(ws_id, started)
+    return len(tasks)
+
+
+def manifest_path(path):
+    """ Path of the sidecar manifest describing weeks exported to `path` """
+    return path + '.manifest.json'
+
+
+def exported_weeks(path, header, workspaces, include_inactive):
+    """ Get weeks of a previous export which don't need to be fetched again
+
+    Manifest lists byte ranges of every exported week with their checksums.
+    Weeks are reused up to the first one which was still open at the time of
+    export or doesn't match its checksum anymore.
+    :param path: path of the detailed report CSV
+    :param header: expected CSV header line
+    :param workspaces: list of (ws_name, ws_id) tuples
+    :param include_inactive: value of --all option
+    :return: list of manifest week entries, possibly empty
+    """
+    try:
+        with open(manifest_path(path)) as fh:
+            manifest = json.load(fh)
+        with open(path, 'rb') as fh:
+            if fh.read(len(header)) != header.encode('utf8'):
+                return []
+            if manifest['workspaces'] != [list(w) for w in workspaces] or \
+                    manifest['include_inactive'] != include_inactive:
+                return []
+            weeks = []
+            for week in manifest['weeks']:
+                fh.seek(week['offset'])
+                checksum = hashlib.sha1(fh.read(week['length'])).hexdigest()
+                if not week['closed'] or checksum != week['sha1']:
+                    break
+                weeks.append(week)
+            return weeks
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return []
+
+
+def write_manifest(path, weeks, workspaces, include_inactive):
+    """ Save manifest of an exported detailed report
+    :param weeks: list of dicts with keys monday, offset and closed, in the
+        order of weeks in the file. Length and checksum are added here
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(0, 2)
+        end = fh.tell()
+        for week, next_week in zip(weeks, weeks[1:] + [{'offset': end}]):
+            week['length'] = next_week['offset'] - week['offset']
+            fh.seek(week['offset'])
+            week['sha1'] = hashlib.sha1(fh.read(week['length'])).hexdigest()
+
+    with open(manifest_path(path), 'w') as fh:
+        json.dump({
+            'workspaces': workspaces,
+            'include_inactive': include_inactive,
+            'weeks': weeks,
+        }, fh, indent=2)
+
+
 if __name__ == '__main__':
     # parse parameters
     parser = argparse.ArgumentParser(
@@ -36,7 +323,6 @@ if __name__ == '__main__':
                     "Typical usage:\n"
                     "./detailed_report.py > detailed_report.csv")
     parser.add_argument('-o', '--output', default="-",
-                        type=argparse.FileType('w'),
                         help='Output filename, "-" or skip for stdout')
     parser.add_argument('-d', '--date', help='system date override, YYYY-MM-DD')
     parser.add_argument('-v', '--verbose',  default=3,
@@ -44,6 +330,26 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--all', action='store_true',
                         help="Include records from disabled users (omitted by "
                              "default)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of workspaces fetched concurrently,"
+                             " default: 1")
+    parser.add_argument('-c', '--cache',
+                        help="Path to a persistent response cache (SQLite). "
+                             "Reports on closed weeks are reused across runs")
+    parser.add_argument('-s', '--store',
+                        help="Path to a local SQLite store to save fetched "
+                             "time entries to")
+    parser.add_argument('-f', '--format', default='csv', choices=FORMATS,
+                        help="Output format, default: csv")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="Only fetch weeks missing from the existing "
+                             "output file or still open at the time of "
+                             "previous export")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print Toggl API request statistics to stderr")
+    parser.add_argument('--prometheus',
+                        help="Save Toggl API request statistics to a file in "
+                             "Prometheus text format")
     args = parser.parse_args()
 
     date_format = "%Y-%m-%d"
@@ -70,36 +376,76 @@ if __name__ == '__main__':
                        "the settings.py\n".format(start_date))
 
     # create report
-    toggl = Toggl(settings.api_token)
-    workspaces = [(w['name'], w['id']) for w in toggl.get_workspaces()]
-
-    weeks = week_list(start_date, today)
-
-    report_writer = csv.DictWriter(
-        args.output, ['user', 'team', 'project', 'start', 'duration'])
-    report_writer.writeheader()
-
-    for (monday, sunday) in weeks:
-        if sunday > today:
-            break
-
-        for ws_name, ws_id in workspaces:
-            inactive_users = set() if args.all else \
-                set(u['name'] for u in
-                    toggl.get_workspace_users(ws_id, inactive=True))
-
-            for record in toggl.detailed_report(ws_id, monday, sunday):
-                # exclude inactive users
-                if record['user'] in inactive_users:
-                    continue
-
-                # record duration is in milliseconds
-                # divide by 3600000 to convert to hours
-                report_writer.writerow({
-                    'user': record['user'],
-                    'team': ws_name,
-                    'project': record['project'],
-                    # example of record['start']: 2015-05-29T16:07:20+03:00
-                    'start': record['start'][:19],
-                    'duration': round(float(record['dur']) / 3600000, 2)
-                })
+    # in-memory cache is bounded so that closed weeks' report pages
+    # don't pile up in memory
+    metrics = Metrics()
+    toggl = Toggl(settings.api_token, cache=SQLiteCache(args.cache)
+                  if args.cache else MemoryCache(max_entries=100),
+                  metrics=metrics)
+    workspaces = [(w['name'], w['id'])
+                  for w in toggl.metadata.workspaces().values()]
+
+    weeks = [(monday, sunday) for (monday, sunday)
+             in week_list(start_date, today) if sunday <= today]
+    workspaces = [list(w) for w in workspaces]
+
+    fieldnames = ['user', 'team', 'project', 'start', 'duration']
+    header = ','.join(fieldnames) + '\r\n'
+
+    # weeks of the previous export that can be kept as is
+    kept_weeks = []
+    if args.incremental:
+        if args.output == '-' or args.format != 'csv':
+            parser.exit(1, "Incremental mode needs an output CSV file\n")
+        for week, (monday, _) in zip(
+                exported_weeks(args.output, header, workspaces, args.all),
+                weeks):
+            if week['monday'] != monday.strftime(date_format):
+                break
+            kept_weeks.append(week)
+        logging.info("Reusing %d exported weeks", len(kept_weeks))
+
+    if kept_weeks:
+        last_week = kept_weeks[-1]
+        with open(args.output, 'r+b') as fh:
+            fh.truncate(last_week['offset'] + last_week['length'])
+        output = open(args.output, 'a')
+    elif args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'w')
+
+    report_writer = open_writer(output, fieldnames, args.format)
+    if not kept_weeks:
+        report_writer.writeheader()
+
+    tasks = [(workspace, monday, sunday)
+             for (monday, sunday) in weeks[len(kept_weeks):]
+             for workspace in workspaces]
+
+    exported = [dict(week) for week in kept_weeks]
+    store = TimeEntryStore(args.store) if args.store else None
+    for (_, monday, sunday), rows in fetch_tasks(
+            toggl, tasks, args.all, args.workers, store):
+        if output is not sys.stdout and args.format == 'csv' and \
+                (not exported or
+                 exported[-1]['monday'] != monday.strftime(date_format)):
+            output.flush()
+            exported.append({
+                'monday': monday.strftime(date_format),
+                'offset': output.tell(),
+                'closed': sunday.date() < today.date(),
+            })
+        report_writer.writerows(rows)
+
+    report_writer.close()
+    if output is not sys.stdout:
+        output.close()
+        if args.format == 'csv':
+            write_manifest(args.output, exported, workspaces, args.all)
+
+    if args.stats:
+        sys.stderr.write(metrics.summary())
+    if args.prometheus:
+        with open(args.prometheus, 'w') as fh:
+            fh.write(metrics.prometheus())
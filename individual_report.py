@@ -3,42 +3,111 @@
 import argparse
 import csv
 import datetime
+import heapq
 import sys
 from collections import defaultdict
 
 import settings
+from columnar import FORMATS, open_reader, open_writer
+
+try:  # optional, only needed for the numpy aggregation engine
+    import numpy
+except ImportError:
+    numpy = None
 
 detailed_report_date_format = "%Y-%m-%dT%H:%M:%S"
+violations_fieldnames = ['user', 'team', 'duration', 'project', 'date', 'rule']
+
+
+def parse_timestamp(date_str):
+    """ Parse detailed report timestamp, e.g. 2015-05-29T16:07:20
+    Same as strptime(date_str, detailed_report_date_format), but several
+    times faster since the format is fixed
+    """
+    return datetime.datetime(
+        int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]),
+        int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]))
+
+
+# week names by calendar date, e.g. {'2015-05-29': 'May 25'}
+_week_names = {}
 
 
 def week(date_str):
-    d = datetime.datetime.strptime(date_str, detailed_report_date_format)
-    d -= datetime.timedelta(days=d.weekday())
-    return d.strftime(settings.report_date_format)
+    """ Name of the week (its Monday in settings.report_date_format) of the
+    detailed report timestamp
+    """
+    date = date_str[:10]
+    try:
+        return _week_names[date]
+    except KeyError:
+        d = datetime.date(int(date[:4]), int(date[5:7]), int(date[8:10]))
+        d -= datetime.timedelta(days=d.weekday())
+        name = _week_names[date] = d.strftime(settings.report_date_format)
+        return name
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description="Generate individual report CSV from detailed report CSV. "
-                    "Detailed report CSV accepted from standard input, "
-                    "individual report printed to stadard output.\n Detailed "
-                    "report entries also validated, validation notes printed to"
-                    " stderr.\n"
-                    "Typical usage:\n"
-                    "   ./detailed_report.py | tee detailed_report.csv | "
-                    "./individual_report.py > individual_report.csv 2> "
-                    "reporting_violations.csv")
-    parser.add_argument('-i', '--input', default="-", nargs="?",
-                        type=argparse.FileType('r'),
-                        help='File to use as input, empty or "-" for stdin')
-    parser.add_argument('-o', '--output', default="-",
-                        type=argparse.FileType('w'),
-                        help='Output filename, "-" or skip for stdout')
-    parser.add_argument('-n', '--threshold', type=int, default=10,
-                        help='time record threshold in hours')
-    args = parser.parse_args()
 
+def find_overlaps(entries):
+    """ Find all pairs of overlapping time entries of the same user
+
+    Entries are indexed by user and swept in the order of start time,
+    keeping a heap of entries still running, so the input can be in any
+    order. Complexity is O(n log n + k), k is the number of overlaps.
+    :param entries: iterable of (user, start, end, key) tuples, start and end
+        should be comparable
+    :return: list of (key, other_key) tuples, where `key` entry starts after
+        or at the same time as `other_key` entry
+    """
+    intervals = defaultdict(list)
+    for user, start, end, key in entries:
+        intervals[user].append((start, end, key))
+
+    pairs = []
+    for user_intervals in intervals.values():
+        user_intervals.sort(key=lambda interval: interval[:2])
+        running = []  # heap of (end, start, index, key)
+        for i, (start, end, key) in enumerate(user_intervals):
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+            pairs.extend((key, other[3]) for other in sorted(
+                running, key=lambda interval: interval[1:3]))
+            heapq.heappush(running, (end, start, i, key))
+    return pairs
+
+
+def write_overlaps(err_writer, pairs):
+    """ Report overlapping entries found by find_overlaps()
+    :param pairs: list of (entry, other_entry), entries are tuples
+        (user, team, project, start, hours)
+    """
+    for (user, team, project, start, hours), other in pairs:
+        err_writer.writerow({
+            'user': user,
+            'team': team,
+            'rule': 'overlaps: %s %s and %s %s' % (
+                start, project, other[3], other[2]),
+            'duration': hours,
+            'project': project,
+            'date': start[:10],
+        })
+
+
+def individual_report(records, err_writer, threshold=10):
+    """ Aggregate detailed report records by users and weeks, validating them
+
+    Missing project and long records are reported as they are read,
+    overlapping entries are reported after all records are read.
+    :param records: iterable of detailed report dicts with keys
+        ['user', 'team', 'project', 'start', 'duration']
+    :param err_writer: csv.DictWriter with violations_fieldnames to report
+        time logging violations to
+    :param threshold: time record threshold in hours
+    :return: (week_names, rows), rows are dicts with keys
+        ['user', 'team', 'project', 'average'] + week_names
+    """
     # helper variables
-    last_records = {}
+    # (user, start, end, (user, team, project, start, hours)) for every record
+    intervals = []
     week_names = []
 
     # individual_report[user][team][project][week_name] = hours
@@ -47,14 +116,7 @@ if __name__ == '__main__':
             lambda: defaultdict(
                 lambda: defaultdict(lambda: 0))))
 
-    # record.keys() = ['user', 'team', 'project', 'start', 'duration']
-    reader = csv.DictReader(args.input)
-
-    err_writer = csv.DictWriter(
-        sys.stderr, ['user', 'team', 'duration', 'project', 'date', 'rule'])
-    err_writer.writeheader()
-
-    for record in reader:
+    for record in records:
         week_name = week(record['start'])
         if not week_names or week_names[-1] != week_name:
             week_names.append(week_name)
@@ -66,9 +128,9 @@ if __name__ == '__main__':
         # this duration is only used to check for overlapping entries and
         # should not affect overall statistics
         duration = datetime.timedelta(hours=hours, minutes=-1)
-        end = datetime.datetime.strptime(
-            record['start'], detailed_report_date_format) + duration
-        record['end'] = end.strftime(detailed_report_date_format)
+        start = parse_timestamp(record['start'])
+        # timestamps are compared with one second precision
+        end = (start + duration).replace(microsecond=0)
         user = record['user']
         project = record['project']
         team = record['team']
@@ -88,28 +150,16 @@ if __name__ == '__main__':
                 'date': record_date,
             })
 
-        # check for overlapping entry
-        if user in last_records and \
-                last_records[user]['end'] > record['start']:
-            err_writer.writerow({
-                'user': user,
-                'team': team,
-                'rule': 'overlaps: %(start)s %(project)s' % record,
-                'duration': hours,
-                'project': project,
-                'date': record_date,
-            })
-            if record['end'] > last_records[user]['end']:
-                last_records[user] = record
-        else:
-            last_records[user] = record
+        # overlapping entries are checked after all records are read
+        intervals.append(
+            (user, start, end, (user, team, project, record['start'], hours)))
 
         # long records
-        if hours > args.threshold:
+        if hours > threshold:
             err_writer.writerow({
                 'user': user,
                 'team': team,
-                'rule': 'record > %s hours' % args.threshold,
+                'rule': 'record > %s hours' % threshold,
                 'duration': hours,
                 'project': project,
                 'date': record_date,
@@ -117,11 +167,10 @@ if __name__ == '__main__':
 
         individual_report[user][team][project][week_name] += hours
 
-    # Now we'll aggregate stats, calculate average etc
-    report_writer = csv.DictWriter(
-        args.output, ['user', 'team', 'project', 'average'] + week_names)
-    report_writer.writeheader()
+    write_overlaps(err_writer, find_overlaps(intervals))
 
+    # Now we'll aggregate stats, calculate average etc
+    rows = []
     for user, user_records in individual_report.items():
         for team, user_team_records in user_records.items():
             for project, user_team_project_records in user_team_records.items():
@@ -136,4 +185,184 @@ if __name__ == '__main__':
                     'project': project,
                     'average': round(average, 2),
                 })
-                report_writer.writerow(records)
+                rows.append(records)
+
+    return week_names, rows
+
+
+def individual_report_numpy(records, err_writer, threshold=10):
+    """ Same as individual_report(), but using NumPy column operations
+
+    Records are loaded into columns, timestamps are parsed in bulk and the
+    weekly pivot is computed with grouped sums. Sums are accumulated in the
+    order of records, so the output is identical to individual_report().
+    """
+    if numpy is None:
+        raise ImportError("numpy aggregation engine requires NumPy")
+
+    columns = ('user', 'team', 'project', 'start', 'duration')
+    users, teams, projects, starts, durations = [], [], [], [], []
+    for record in records:
+        for column, value in zip(
+                (users, teams, projects, starts, durations),
+                (record[c] for c in columns)):
+            column.append(value)
+    if not starts:
+        return [], []
+
+    no_project = numpy.array([not p for p in projects], dtype=bool)
+    projects = [p or '(no project)' for p in projects]
+    hours_list = [float(d) for d in durations]
+    hours = numpy.array(hours_list)
+    start_times = numpy.array(starts, dtype='datetime64[s]')
+
+    # week names. 1970-01-01 was Thursday, i.e. weekday 3
+    days = start_times.astype('datetime64[D]')
+    mondays = days - ((days.view('int64') + 3) % 7).astype('timedelta64[D]')
+    unique_mondays, monday_codes = numpy.unique(mondays, return_inverse=True)
+    label_codes = {}
+    for monday in unique_mondays:
+        label_codes.setdefault(week(str(monday) + 'T00:00:00'),
+                               len(label_codes))
+    labels = sorted(label_codes, key=label_codes.get)
+    week_codes = numpy.array(
+        [label_codes[week(str(m) + 'T00:00:00')] for m in unique_mondays]
+    )[monday_codes.ravel()]
+    changes = numpy.flatnonzero(week_codes[1:] != week_codes[:-1]) + 1
+    week_names = [labels[c] for c in
+                  week_codes[numpy.concatenate(([0], changes))].tolist()]
+
+    # group codes for (user, team, project)
+    user_names, user_codes = numpy.unique(users, return_inverse=True)
+    team_names, team_codes = numpy.unique(teams, return_inverse=True)
+    project_names, project_codes = numpy.unique(projects, return_inverse=True)
+    user_codes = user_codes.ravel().astype('int64')
+    user_team = user_codes * len(team_names) + team_codes.ravel()
+    user_team_project = user_team * len(project_names) + project_codes.ravel()
+    groups, group_first, group_codes = numpy.unique(
+        user_team_project, return_index=True, return_inverse=True)
+    group_codes = group_codes.ravel()
+
+    # output order is the same as in nested dicts of individual_report():
+    # by first appearance of the user, then user/team, then user/team/project
+    _, user_first = numpy.unique(user_codes, return_index=True)
+    user_team_names, user_team_first = numpy.unique(
+        user_team, return_index=True)
+    group_user_team = groups // len(project_names)
+    group_user = group_user_team // len(team_names)
+    order = numpy.lexsort((
+        group_first,
+        user_team_first[numpy.searchsorted(user_team_names, group_user_team)],
+        user_first[group_user]))
+
+    # weekly pivot
+    cells = group_codes * len(labels) + week_codes
+    size = len(groups) * len(labels)
+    totals = numpy.bincount(cells, weights=hours, minlength=size).reshape(
+        len(groups), len(labels))
+    counts = numpy.bincount(cells, minlength=size).reshape(
+        len(groups), len(labels))
+
+    # TIME LOGGING SANITY CHECK
+    # -1 minute is to compensate for round error in conversion to hours
+    start_seconds = start_times.view('int64')
+    end_seconds = (start_seconds * 1000000 +
+                   numpy.round(hours * 3600000000).astype('int64') -
+                   60000000) // 1000000
+    long_records = hours > threshold
+
+    for i in numpy.flatnonzero(no_project | long_records).tolist():
+        violation = {
+            'user': users[i],
+            'team': teams[i],
+            'duration': hours_list[i],
+            'project': projects[i],
+            'date': starts[i][:10],
+        }
+        if no_project[i]:
+            violation['rule'] = 'record without project'
+            err_writer.writerow(violation)
+        if long_records[i]:
+            violation['rule'] = 'record > %s hours' % threshold
+            err_writer.writerow(violation)
+
+    pairs = find_overlaps(zip(user_codes.tolist(), start_seconds.tolist(),
+                              end_seconds.tolist(), range(len(starts))))
+    write_overlaps(err_writer, [
+        tuple((users[i], teams[i], projects[i], starts[i], hours_list[i])
+              for i in pair) for pair in pairs])
+
+    rows = []
+    for group in order.tolist():
+        group_totals = totals[group].tolist()
+        group_counts = counts[group].tolist()
+        records = {
+            week_name: round(group_totals[label_codes[week_name]], 2)
+            if group_counts[label_codes[week_name]] else 0
+            for week_name in week_names
+        }
+        average = sum(records.values()) / len(records)
+        code = groups[group]
+        records.update({
+            'user': str(user_names[group_user[group]]),
+            'team': str(team_names[group_user_team[group] % len(team_names)]),
+            'project': str(project_names[code % len(project_names)]),
+            'average': round(average, 2),
+        })
+        rows.append(records)
+
+    return week_names, rows
+
+
+engines = {
+    'python': individual_report,
+    'numpy': individual_report_numpy,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Generate individual report CSV from detailed report CSV. "
+                    "Detailed report CSV accepted from standard input, "
+                    "individual report printed to stadard output.\n Detailed "
+                    "report entries also validated, validation notes printed to"
+                    " stderr.\n"
+                    "Typical usage:\n"
+                    "   ./detailed_report.py | tee detailed_report.csv | "
+                    "./individual_report.py > individual_report.csv 2> "
+                    "reporting_violations.csv")
+    parser.add_argument('-i', '--input', default="-", nargs="?",
+                        type=argparse.FileType('r'),
+                        help='File to use as input, empty or "-" for stdin')
+    parser.add_argument('-o', '--output', default="-",
+                        type=argparse.FileType('w'),
+                        help='Output filename, "-" or skip for stdout')
+    parser.add_argument('-n', '--threshold', type=int, default=10,
+                        help='time record threshold in hours')
+    parser.add_argument('-f', '--format', default='csv', choices=FORMATS,
+                        help="Output format, default: csv. Input format is "
+                             "detected automatically")
+    parser.add_argument('-e', '--engine', default='python',
+                        choices=sorted(engines),
+                        help='aggregation engine, default: python. numpy '
+                             'engine is faster on large reports')
+    args = parser.parse_args()
+
+    if args.engine == 'numpy' and numpy is None:
+        parser.exit(1, "numpy engine requires NumPy to be installed\n")
+
+    # record.keys() = ['user', 'team', 'project', 'start', 'duration']
+    reader = open_reader(args.input)
+
+    err_writer = csv.DictWriter(sys.stderr, violations_fieldnames)
+    err_writer.writeheader()
+
+    week_names, rows = engines[args.engine](
+        reader, err_writer, args.threshold)
+
+    report_writer = open_writer(
+        args.output, ['user', 'team', 'project', 'average'] + week_names,
+        args.format)
+    report_writer.writeheader()
+    report_writer.writerows(rows)
+    report_writer.close()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+Build detailed, individual, violations and team reports in a single process.
+Same as
+    ./detailed_report.py | tee detailed.csv | ./individual_report.py \
+        2> violations.csv | tee individual.csv | ./team_report.py > team.csv
+but records are passed between stages in memory instead of CSV text
+"""
+
+import argparse
+import csv
+import datetime
+import logging
+import sys
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import settings
+from columnar import FORMATS, open_writer
+from dashboard import DashboardData
+from toggl import Toggl, MemoryCache, Metrics, SQLiteCache
+from detailed_report import week_list, fetch_tasks, inactive_users, sync_store
+from store import TimeEntryStore
+from individual_report import engines, numpy, violations_fieldnames
+from team_report import TeamReport
+
+
+def detailed_rows(toggl, weeks, workspaces, include_inactive=False,
+                  workers=1, store=None):
+    """ Generate detailed report rows in week/workspace order """
+    tasks = [(workspace, monday, sunday)
+             for (monday, sunday) in weeks
+             for workspace in workspaces]
+    for _, rows in fetch_tasks(toggl, tasks, include_inactive, workers,
+                               store):
+        for row in rows:
+            yield row
+
+
+def summary_rows(toggl, weeks, workspaces, include_inactive=False,
+                 workers=1):
+    """ Individual report built from weekly totals of users by projects
+
+    Instead of every time entry, only a weekly report per week and workspace
+    is fetched. Rows are the same as of individual_report(), except that
+    hours are summed by Toggl before rounding (so they can differ by a few
+    hundredths) and there are no sanity checks.
+    :param weeks: list of (monday, sunday) tuples
+    :param workspaces: list of (ws_name, ws_id) tuples
+    :return: (week_names, rows), see individual_report()
+    """
+    tasks = [(workspace, monday, sunday)
+             for (monday, sunday) in weeks
+             for workspace in workspaces]
+
+    def fetch(task):
+        (_, ws_id), monday, sunday = task
+        return toggl.weekly_report(ws_id, monday, sunday)
+
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            reports = pool.map(fetch, tasks)
+        finally:
+            pool.close()
+    else:
+        reports = map(fetch, tasks)
+
+    week_names = []
+    # milliseconds[user][team][project][week_name] = total duration
+    milliseconds = defaultdict(
+        lambda: defaultdict(
+            lambda: defaultdict(
+                lambda: defaultdict(lambda: 0))))
+    for ((ws_name, ws_id), monday, _), report in zip(tasks, reports):
+        week_name = monday.strftime(settings.report_date_format)
+        skipped = frozenset() if include_inactive \
+            else toggl.metadata.inactive_users(ws_id)
+        for project in report['data']:
+            project_name = project['title']['project'] or '(no project)'
+            for user in project['details']:
+                # totals are daily durations followed by the week total
+                if user['uid'] in skipped or user['totals'][-1] is None:
+                    continue
+                if not week_names or week_names[-1] != week_name:
+                    week_names.append(week_name)
+                milliseconds[user['title']['user']][ws_name][project_name][
+                    week_name] += user['totals'][-1]
+
+    rows = []
+    for user, user_records in milliseconds.items():
+        for team, user_team_records in user_records.items():
+            for project, durations in user_team_records.items():
+                records = {
+                    week_name: round(durations[week_name] / 3600000.0, 2)
+                    if week_name in durations else 0
+                    for week_name in week_names
+                }
+                average = sum(records.values()) / len(records)
+                records.update({
+                    'user': user,
+                    'team': team,
+                    'project': project,
+                    'average': round(average, 2),
+                })
+                rows.append(records)
+    return week_names, rows
+
+
+def tee(rows, writer):
+    """ Write rows with the writer while passing them through """
+    for row in rows:
+        writer.writerow(row)
+        yield row
+
+
+def open_output(path):
+    return sys.stdout if path == '-' else open(path, 'w')
+
+
+if __name__ == '__main__':
+    # parse parameters
+    parser = argparse.ArgumentParser(
+        description="Build team report from Toggl workspace(s) in a single "
+                    "process, optionally saving the intermediate detailed, "
+                    "individual and violations reports.\n"
+                    "Typical usage:\n"
+                    "./report.py --detailed detailed.csv --individual "
+                    "individual.csv --violations violations.csv > team.csv")
+    parser.add_argument('-o', '--output', default="-",
+                        help='Team report filename, "-" or skip for stdout')
+    parser.add_argument('--detailed',
+                        help='Detailed report filename, not saved by default')
+    parser.add_argument('--individual',
+                        help='Individual report filename, not saved by '
+                             'default')
+    parser.add_argument('--violations',
+                        help='Violations report filename, "-" or skip for '
+                             'stderr')
+    parser.add_argument('--dashboard',
+                        help='Directory to save JSON data of team.html and '
+                             'details.html to, not saved by default')
+    parser.add_argument('-f', '--format', default='csv', choices=FORMATS,
+                        help="Format of the detailed, individual and team "
+                             "reports, default: csv")
+    parser.add_argument('-n', '--threshold', type=int, default=10,
+                        help='time record threshold in hours')
+    parser.add_argument('-e', '--engine', default='python',
+                        choices=sorted(engines),
+                        help='aggregation engine of the individual report, '
+                             'default: python')
+    parser.add_argument('-d', '--date', help='system date override, YYYY-MM-DD')
+    parser.add_argument('-v', '--verbose',  default=3,
+                        help="Verboseness, 5: debug, 1: quiet, default: 3")
+    parser.add_argument('-a', '--all', action='store_true',
+                        help="Include records from disabled users (omitted by "
+                             "default)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of workspaces (weeks of workspaces in "
+                             "--summary mode) fetched concurrently, default: "
+                             "1")
+    parser.add_argument('-c', '--cache',
+                        help="Path to a persistent response cache (SQLite). "
+                             "Reports on closed weeks are reused across runs")
+    parser.add_argument('-s', '--store',
+                        help="Path to a local SQLite store of time entries. "
+                             "Fetched entries are saved to it")
+    parser.add_argument('--sync', action='store_true',
+                        help="Only fetch changes since the previous run into "
+                             "the --store, then build reports from it. "
+                             "Toggl only lists changes of the API token "
+                             "owner's entries, so workspaces with other "
+                             "users are fetched again, see --sync-lookback")
+    parser.add_argument('--sync-lookback', type=int,
+                        help="Number of weeks before the previous --sync "
+                             "re-fetched in workspaces with other users, "
+                             "default: the whole period. Older edits of "
+                             "their entries are missed")
+    parser.add_argument('--offline', action='store_true',
+                        help="Build reports from the --store only, without "
+                             "calling Toggl API. Workspaces are ordered by "
+                             "name")
+    parser.add_argument('--summary', action='store_true',
+                        help="Build individual and team reports from weekly "
+                             "totals instead of all time entries, much less "
+                             "data to download. Time entries are still "
+                             "fetched if --detailed or --violations report "
+                             "is requested")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print Toggl API request statistics to stderr")
+    parser.add_argument('--prometheus',
+                        help="Save Toggl API request statistics to a file in "
+                             "Prometheus text format")
+    args = parser.parse_args()
+
+    date_format = "%Y-%m-%d"
+    start_date = settings.start_date
+
+    try:  # verboseness
+        verboseness = max(1, 5 - int(args.verbose) * 1) * 10
+    except ValueError:
+        verboseness = 30
+    logging.basicConfig(level=verboseness)
+
+    today = datetime.datetime.now()
+    if args.date is not None:
+        try:
+            today = datetime.datetime.strptime(args.date, date_format)
+        except ValueError:
+            parser.exit(1, "Invalid date\n")
+
+    if today < start_date:
+        parser.exit(1, "Start date ({0}) has not yet come.\n Check dates in"
+                       "the settings.py\n".format(start_date))
+
+    if args.engine == 'numpy' and numpy is None:
+        parser.exit(1, "numpy engine requires NumPy to be installed\n")
+
+    if (args.offline or args.sync) and not args.store:
+        parser.exit(1, "Offline and sync modes need a --store\n")
+
+    if args.summary and args.store:
+        parser.exit(1, "Summary mode doesn't fetch time entries to --store\n")
+    if args.summary and (args.detailed or args.violations or args.dashboard):
+        logging.info("Detailed, violations and dashboard data need time "
+                     "entries, summary mode is off")
+        args.summary = False
+
+    weeks = [(monday, sunday) for (monday, sunday)
+             in week_list(start_date, today) if sunday <= today]
+    store = TimeEntryStore(args.store) if args.store else None
+    metrics = Metrics()
+
+    if args.offline:
+        records = store.entries(weeks[0][0], weeks[-1][0],
+                                include_inactive=args.all) if weeks else []
+    else:
+        toggl = Toggl(settings.api_token, cache=SQLiteCache(args.cache)
+                      if args.cache else MemoryCache(max_entries=100),
+                      metrics=metrics)
+        toggl.sync_lookback = args.sync_lookback
+        workspaces = [(w['name'], w['id'])
+                      for w in toggl.metadata.workspaces().values()]
+        if args.sync:
+            for ws_name, ws_id in workspaces:
+                inactive_users(toggl, ws_id, store=store)
+            if weeks:
+                sync_store(toggl, store, workspaces, weeks, args.workers)
+            records = store.entries(
+                weeks[0][0], weeks[-1][0], [ws_id for _, ws_id in workspaces],
+                include_inactive=args.all) if weeks else []
+        elif not args.summary:
+            records = detailed_rows(toggl, weeks, workspaces, args.all,
+                                    args.workers, store)
+    if args.detailed:
+        detailed_output = open_output(args.detailed)
+        detailed_writer = open_writer(
+            detailed_output, ['user', 'team', 'project', 'start', 'duration'],
+            args.format)
+        detailed_writer.writeheader()
+        records = tee(records, detailed_writer)
+    if args.dashboard:
+        dashboard = DashboardData(args.dashboard)
+        records = tee(records, dashboard)
+
+    if args.summary:
+        week_names, individual_rows = summary_rows(
+            toggl, weeks, workspaces, args.all, args.workers)
+    else:
+        violations_output = sys.stderr if args.violations in (None, '-') \
+            else open(args.violations, 'w')
+        err_writer = csv.DictWriter(violations_output, violations_fieldnames)
+        err_writer.writeheader()
+
+        week_names, individual_rows = engines[args.engine](
+            records, err_writer, args.threshold)
+        violations_output.flush()
+    if args.detailed:
+        detailed_writer.close()
+        detailed_output.flush()
+
+    if args.individual:
+        individual_output = open_output(args.individual)
+        individual_writer = open_writer(
+            individual_output,
+            ['user', 'team', 'project', 'average'] + week_names, args.format)
+        individual_writer.writeheader()
+        individual_rows = tee(individual_rows, individual_writer)
+
+    # team report is aggregated as individual records are produced
+    team_aggregator = TeamReport(week_names)
+    for row in individual_rows:
+        team_aggregator.add(row)
+    if args.individual:
+        individual_writer.close()
+        individual_output.flush()
+
+    team_output = open_output(args.output)
+    team_writer = open_writer(
+        team_output, ['team', 'project', 'average', 'std'] + week_names,
+        args.format)
+    team_writer.writeheader()
+    team_rows = team_aggregator.rows()
+    team_writer.writerows(team_rows)
+    team_writer.close()
+    team_output.flush()
+
+    if args.dashboard:
+        dashboard.set_team_report(week_names, team_rows)
+        dashboard.close()
+
+    if args.stats:
+        sys.stderr.write(metrics.summary())
+    if args.prometheus:
+        with open(args.prometheus, 'w') as fh:
+            fh.write(metrics.prometheus())
@@ -0,0 +1,208 @@
+"""
+Local SQLite store of Toggl time entries
+
+Entries are keyed by Toggl time entry id, so fetching the same period again
+updates them in place. Report scripts can build their output straight from
+the store, without calling Toggl API:
+
+    store = TimeEntryStore('toggl.sqlite')
+    store.replace_range(ws_id, ws_name, monday, sunday,
+                        toggl.detailed_report(ws_id, monday, sunday))
+    for row in store.entries(since, until):
+        ...  # same dicts as detailed_report.py rows
+"""
+
+import datetime
+import sqlite3
+import threading
+
+date_format = '%Y-%m-%d'
+
+
+def _date(value):
+    """ Format date or datetime as YYYY-MM-DD, strings are passed as is """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime(date_format)
+    return value
+
+
+def _monday(start):
+    """ Monday of the week of the detailed report timestamp, YYYY-MM-DD """
+    d = datetime.date(int(start[:4]), int(start[5:7]), int(start[8:10]))
+    return (d - datetime.timedelta(days=d.weekday())).strftime(date_format)
+
+
+class TimeEntryStore(object):
+    """ Time entries of Toggl detailed reports in a SQLite database
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,  -- Toggl time entry id
+                wid INTEGER NOT NULL,
+                team TEXT NOT NULL,  -- workspace name
+                uid INTEGER,
+                user TEXT,
+                pid INTEGER,
+                project TEXT,
+                start TEXT NOT NULL,  -- local time, YYYY-MM-DDTHH:MM:SS
+                week TEXT NOT NULL,  -- monday, YYYY-MM-DD
+                dur INTEGER NOT NULL,  -- milliseconds
+                updated TEXT
+            );
+            CREATE INDEX IF NOT EXISTS entries_wid_uid_start
+                ON entries(wid, uid, start);
+            CREATE INDEX IF NOT EXISTS entries_pid_week
+                ON entries(pid, week);
+            CREATE INDEX IF NOT EXISTS entries_week
+                ON entries(week, wid, start);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                wid INTEGER PRIMARY KEY,
+                synced REAL NOT NULL  -- unix timestamp of the last sync
+            );
+            CREATE TABLE IF NOT EXISTS inactive_users (
+                wid INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                PRIMARY KEY (wid, uid)
+            );
+        """)
+        self._db.commit()
+
+    def _upsert(self, wid, team, records):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO entries VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((r['id'], wid, team, r.get('uid'), r.get('user'), r.get('pid'),
+              r.get('project'), r['start'][:19], _monday(r['start']),
+              r['dur'], r.get('updated')) for r in records))
+
+    def upsert(self, wid, team, records):
+        """ Insert or update time entries
+        :param wid: workspace id
+        :param team: workspace name
+        :param records: iterable of detailed report records, as returned by
+            Toggl.detailed_report()
+        """
+        with self._lock:
+            self._upsert(wid, team, records)
+            self._db.commit()
+
+    def replace_range(self, wid, team, since, until, records):
+        """ Replace all entries of a workspace between two dates, inclusive
+        Unlike upsert(), this also removes entries deleted in Toggl.
+        """
+        until = datetime.datetime.strptime(_date(until), date_format) + \
+            datetime.timedelta(days=1)
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM entries WHERE wid = ? AND start >= ? "
+                "AND start < ?", (wid, _date(since), _date(until)))
+            self._upsert(wid, team, records)
+            self._db.commit()
+
+    def delete(self, ids):
+        """ Delete time entries by their ids """
+        with self._lock:
+            self._db.executemany("DELETE FROM entries WHERE id = ?",
+                                 ((i,) for i in ids))
+            self._db.commit()
+
+    def synced_at(self, wid):
+        """ Time of the last sync of the workspace, see detailed_report.sync_store()
+        :return: unix timestamp or None if it was never synced
+        """
+        rows = self._query("SELECT synced FROM sync_state WHERE wid = ?",
+                           (wid,))
+        return rows[0][0] if rows else None
+
+    def set_synced_at(self, wid, timestamp):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                             (wid, timestamp))
+            self._db.commit()
+
+    def set_inactive_users(self, wid, uids):
+        """ Set ids of disabled users of a workspace
+        Their entries are omitted by entries() by default.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM inactive_users WHERE wid = ?",
+                             (wid,))
+            self._db.executemany("INSERT INTO inactive_users VALUES (?, ?)",
+                                 ((wid, uid) for uid in set(uids)))
+            self._db.commit()
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _where(self, since, until, workspaces, include_inactive):
+        """ WHERE clause and its params shared by queries """
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("e.week >= ?")
+            params.append(_date(since))
+        if until is not None:
+            conditions.append("e.week <= ?")
+            params.append(_date(until))
+        if workspaces is not None:
+            conditions.append(
+                "e.wid IN (%s)" % ','.join('?' * len(workspaces)))
+            params.extend(workspaces)
+        if not include_inactive:
+            conditions.append(
+                "NOT EXISTS (SELECT 1 FROM inactive_users i "
+                "WHERE i.wid = e.wid AND i.uid = e.uid)")
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where, params
+
+    def entries(self, since=None, until=None, workspaces=None,
+                include_inactive=False):
+        """ Time entries in the same format as detailed_report.py rows
+        :param since: first week (its Monday), date or YYYY-MM-DD string
+        :param until: last week (its Monday), inclusive
+        :param workspaces: list of workspace ids, all by default. Entries of
+            every week are ordered in the order of workspaces in this list
+        :param include_inactive: include entries of disabled users
+        :return: list of dicts with keys: user, team, project, start, duration
+            ordered by week, workspace and start time
+        """
+        where, params = self._where(since, until, workspaces,
+                                    include_inactive)
+        order = "e.team"
+        if workspaces:
+            order = "CASE e.wid %s END" % " ".join(
+                "WHEN %d THEN %d" % (int(wid), i)
+                for i, wid in enumerate(workspaces))
+        rows = self._query(
+            "SELECT e.user, e.team, e.project, e.start, e.dur FROM entries e"
+            + where + " ORDER BY e.week, " + order + ", e.start, e.id",
+            params)
+        return [{
+            'user': user,
+            'team': team,
+            'project': project,
+            'start': start,
+            'duration': round(float(dur) / 3600000, 2),
+        } for user, team, project, start, dur in rows]
+
+    def weekly_totals(self, since=None, until=None, workspaces=None,
+                      include_inactive=False):
+        """ Total hours per user, team, project and week
+        Parameters are the same as of entries()
+        :return: list of (user, team, project, week, hours) tuples, week is
+            its Monday as YYYY-MM-DD
+        """
+        where, params = self._where(since, until, workspaces,
+                                    include_inactive)
+        return self._query(
+            "SELECT e.user, e.team, e.project, e.week, "
+            "SUM(e.dur) / 3600000.0 FROM entries e" + where +
+            " GROUP BY e.user, e.team, e.project, e.week"
+            " ORDER BY e.week, e.team, e.user, e.project", params)
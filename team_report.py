@@ -1,16 +1,98 @@
 #!/usr/bin/env python
 
 import argparse
-import csv
+import array
 from collections import defaultdict
 import math
 
+from columnar import FORMATS, open_reader, open_writer
+
 
 def std(values):
     avg = sum(values) / len(values)
     return math.sqrt(sum([(avg - v) ** 2 for v in values]) / len(values))
 
 
+class TeamReport(object):
+    """ Streaming aggregation of individual report records by teams
+
+    Only weekly totals of every team/project and the set of members of every
+    team are kept, so memory doesn't depend on the number of records.
+
+    Example:
+        aggregator = TeamReport(week_names)
+        for record in individual_report_records:
+            aggregator.add(record)
+        rows = aggregator.rows()
+    """
+
+    def __init__(self, week_names):
+        """
+        :param week_names: list of week names, in the order of report columns
+        """
+        self.week_names = week_names
+        # position of every week in totals arrays
+        self._week_index = {}
+        for week_name in week_names:
+            self._week_index.setdefault(week_name, len(self._week_index))
+        # totals[team][project] = array of hours per week
+        self._totals = {}
+        # this structure is used to see how many members in each team
+        self._team_members = defaultdict(set)
+
+    def add(self, record):
+        """ Add an individual report record, i.e. a dict with keys
+        ['user', 'team', 'project', 'average'] + week_names
+        """
+        team_totals = self._totals.setdefault(record['team'], {})
+        totals = team_totals.get(record['project'])
+        if totals is None:
+            totals = team_totals[record['project']] = \
+                array.array('d', [0.0] * len(self._week_index))
+
+        for week_name in self.week_names:
+            totals[self._week_index[week_name]] += float(record[week_name])
+
+        self._team_members[record['team']].add(record['user'])
+
+    def rows(self):
+        """ Team report rows aggregated so far
+        :return: list of dicts with keys ['team', 'project', 'average', 'std']
+            + week_names
+        """
+        rows = []
+        for team, team_totals in self._totals.items():
+            members = len(self._team_members[team])
+            for project, totals in team_totals.items():
+                records = {
+                    week: round(totals[self._week_index[week]] / members, 2)
+                    for week in self.week_names
+                }
+                values = list(records.values())
+                records.update({
+                    'team': team,
+                    'project': project,
+                    'average': round(sum(values) / len(values), 2),
+                    'std': round(std(values), 2),
+                })
+                rows.append(records)
+        return rows
+
+
+def team_report(records, week_names):
+    """ Aggregate individual report records by teams
+    :param records: iterable of individual report dicts with keys
+        ['user', 'team', 'project', 'average'] + week_names
+    :param week_names: list of week names, in the order of report columns
+    :return: list of dicts with keys ['team', 'project', 'average', 'std'] +
+        week_names
+    """
+    aggregator = TeamReport(week_names)
+    for record in records:
+        aggregator.add(record)
+    return aggregator.rows()
+
+
 if __name__ == '__main__':
     # parse parameters
     parser = argparse.ArgumentParser(
@@ -26,52 +108,20 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', default="-",
                         type=argparse.FileType('w'),
                         help='Output filename, "-" or skip for stdout')
+    parser.add_argument('-f', '--format', default='csv', choices=FORMATS,
+                        help="Output format, default: csv. Input format is "
+                             "detected automatically")
     args = parser.parse_args()
 
     # reader record = ['user', 'team', 'project', 'avg'] + week_names
-    reader = csv.DictReader(args.input)
+    reader = open_reader(args.input)
     # we need to keep weeks order for symbolic names
     week_names = reader.fieldnames[4:]
 
-    # team_report[team][project][week_name] = hours
-    team_report = defaultdict(
-        lambda: defaultdict(
-            lambda: defaultdict(
-                lambda: 0)))
-
-    # this structure is used to see how many members in each team
-    team_members = defaultdict(set)
-    # average time per project per user to see how balanced is the team effort
-    # averages[team][project] = [ user1_avg, user2_avg, ...]
-    averages = defaultdict(
-        lambda: defaultdict(
-            lambda: []))
-
-    # first step: aggregate by teams and separate electives
-    for record in reader:
-        project = record['project']
-
-        for i, week_name in enumerate(week_names):
-            team_report[record['team']][project][week_name] += \
-                float(record[week_name])
-
-        averages[record['team']][project].append(float(record['average']))
-        team_members[record['team']].add(record['user'])
-
-    report_writer = csv.DictWriter(
-        args.output, ['team', 'project', 'average', 'std'] + week_names)
+    report_writer = open_writer(
+        args.output, ['team', 'project', 'average', 'std'] + week_names,
+        args.format)
     report_writer.writeheader()
-
-    for team, team_records in team_report.items():
-        for project, team_project_records in team_records.items():
-            records = {
-                week: round(team_project_records[week] / len(team_members[team]), 2)
-                for week in week_names
-                }
-            records.update({
-                'team': team,
-                'project': project,
-                'average': round(sum(records.values()) / len(records), 2),
-                'std': round(std(records.values()), 2),
-            })
-            report_writer.writerow(records)
+    # records are aggregated as they are read
+    report_writer.writerows(team_report(reader, week_names))
+    report_writer.close()
@@ -5,6 +5,20 @@ import json
 import logging
 import time
 import base64
+import bisect
+import datetime
+import random
+import re
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+try:  # Python 3.9+, only needed to sync changed time entries
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
 
 
 class TogglException(IOError):
@@ -13,76 +27,768 @@ class TogglException(IOError):
 
 
 class TogglRateLimitException(TogglException):
-    pass
+    def __init__(self, message, retry_after=None):
+        super(TogglRateLimitException, self).__init__(message)
+        self.retry_after = retry_after  # seconds, from Retry-After header
 
 
-class Toggl(object):
-    """ Class to access Toggl API
+class RateLimiter(object):
+    """ Thread safe token bucket rate limiter
 
-    API docs can be found at:
-    https://github.com/toggl/toggl_api_docs/blob/master/reports.md
+    Toggl allows one request per second per API token, so by default requests
+    are spaced to stay within that limit instead of reacting to 429 responses.
+    An instance can be shared by any number of Toggl clients and threads.
+
+    Counters:
+        requests: number of requests passed through the limiter
+        rate_limited: number of times the API asked to slow down
+        throttled_time: total time requests were delayed, in seconds
+    """
+
+    def __init__(self, rate=1.0, capacity=1):
+        """
+        :param rate: tokens (requests) added per second
+        :param capacity: max tokens accumulated, i.e. the burst size
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.throttled_time = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens +
+                           max(0, now - self._updated) * self.rate)
+        self._updated = max(self._updated, now)
+
+    def reserve(self):
+        """ Take a token without blocking
+        :return: number of seconds to wait before using it
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self._tokens -= 1
+            wait = self._updated - now + max(0, -self._tokens / self.rate)
+            self.requests += 1
+            self.throttled_time += wait
+            return wait
+
+    def acquire(self):
+        """ Block until the next request is allowed
+        :return: number of seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return max(wait, 0)
+
+    def pause(self, seconds):
+        """ Hold all requests for the given number of seconds """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            self.rate_limited += 1
+            self._tokens = min(self._tokens, 0)
+            self._updated = max(self._updated, now + seconds)
+
+
+class EndpointStats(object):
+    """ Request statistics of a single API endpoint, see Metrics """
+    __slots__ = ('requests', 'errors', 'time', 'max_time', 'histogram',
+                 'bytes', 'cache_hits', 'cache_misses', 'retries',
+                 'throttled_time')
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.errors = 0  # failed requests and error statuses
+        self.time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (buckets + 1)  # last one is +Inf
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.retries = 0
+        self.throttled_time = 0.0
+
+
+class Metrics(object):
+    """ Thread safe statistics of API requests, per endpoint
+
+    Toggl clients given a metrics object call its on_*() hooks, so a subclass
+    can pass the numbers anywhere else. Endpoints are API urls without the
+    query string and ids, e.g. /api/v8/workspaces/{id}/projects
+
+    Example:
+        metrics = Metrics()
+        toggl = Toggl(api_token, metrics=metrics)
+        ...
+        sys.stderr.write(metrics.summary())
+    """
+    # upper bounds of request latency histogram buckets, in seconds
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.endpoints = {}  # endpoint: EndpointStats
+        self._lock = threading.Lock()
+
+    def _stats(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats(
+                len(self.buckets))
+        return stats
+
+    def on_cache(self, endpoint, hit):
+        """ A GET request was looked up in the cache """
+        with self._lock:
+            stats = self._stats(endpoint)
+            if hit:
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+
+    def on_request(self, endpoint, status, latency, size=0, throttled=0):
+        """ A request was sent to the API
+        :param status: HTTP status, None if no response was received
+        :param latency: seconds from sending the request to reading the body
+        :param size: bytes of the response body received (compressed)
+        :param throttled: seconds the request was held by the rate limiter
+        """
+        with self._lock:
+            stats = self._stats(endpoint)
+            stats.requests += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            stats.time += latency
+            stats.max_time = max(stats.max_time, latency)
+            stats.histogram[bisect.bisect_left(self.buckets, latency)] += 1
+            stats.bytes += size
+            stats.throttled_time += throttled
+
+    def on_retry(self, endpoint, delay):
+        """ A rate limited request is retried after `delay` seconds """
+        with self._lock:
+            self._stats(endpoint).retries += 1
+
+    def summary(self):
+        """ Human readable table of statistics by endpoint """
+        columns = ('requests', 'errors', 'hits', 'misses', 'retries',
+                   'throttled,s', 'MB', 'mean,ms', 'max,ms')
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            width = max([len('endpoint')] + [len(e) for e, _ in endpoints])
+            lines = [' '.join(['endpoint'.ljust(width)] +
+                              ['%11s' % c for c in columns])]
+            for endpoint, s in endpoints:
+                lines.append(
+                    '%s %11d %11d %11d %11d %11d %11.1f %11.2f %11.1f %11.1f' %
+                    (endpoint.ljust(width), s.requests, s.errors,
+                     s.cache_hits, s.cache_misses, s.retries,
+                     s.throttled_time, s.bytes / 1048576.0,
+                     1000 * s.time / s.requests if s.requests else 0,
+                     1000 * s.max_time))
+        return '\n'.join(lines) + '\n'
+
+    def prometheus(self):
+        """ Statistics in Prometheus text exposition format """
+        counters = (
+            ('toggl_requests_total', 'requests', "API requests sent"),
+            ('toggl_request_errors_total', 'errors', "Failed API requests"),
+            ('toggl_response_bytes_total', 'bytes',
+             "Response bytes received"),
+            ('toggl_cache_hits_total', 'cache_hits', "Cache hits"),
+            ('toggl_cache_misses_total', 'cache_misses', "Cache misses"),
+            ('toggl_retries_total', 'retries', "Rate limited retries"),
+            ('toggl_throttled_seconds_total', 'throttled_time',
+             "Time requests were held by the rate limiter"),
+        )
+        lines = []
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            name = 'toggl_request_duration_seconds'
+            lines.append('# HELP %s API request latency' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for endpoint, s in endpoints:
+                count = 0
+                for bound, n in zip(self.buckets + ('+Inf',), s.histogram):
+                    count += n
+                    lines.append('%s_bucket{endpoint="%s",le="%s"} %d' %
+                                 (name, endpoint, bound, count))
+                lines.append('%s_sum{endpoint="%s"} %r' %
+                             (name, endpoint, s.time))
+                lines.append('%s_count{endpoint="%s"} %d' %
+                             (name, endpoint, s.requests))
+            for name, attr, description in counters:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s counter' % name)
+                for endpoint, s in endpoints:
+                    lines.append('%s{endpoint="%s"} %r' %
+                                 (name, endpoint, getattr(s, attr)))
+        return '\n'.join(lines) + '\n'
+
+
+class ConnectionPool(object):
+    """ Thread safe pool of keep-alive connections to the API host
+
+    Connections are created on demand, so the number of concurrent requests
+    is not limited by the pool; up to `size` idle connections are kept open
+    for reuse.
+    """
+
+    def __init__(self, connect, size=8):
+        """
+        :param connect: function creating a new connection
+        :param size: max number of idle connections kept open
+        """
+        self.connect = connect
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Get the most recently used idle connection or a new one """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.connect()
+
+    def release(self, connection):
+        """ Return a connection to the pool once its response is read """
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """ Close all idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class MemoryCache(object):
+    """ In-memory cache backend, used by Toggl by default
+
+    Entries are evicted in LRU order once there are more than `max_entries`
+    of them (unbounded by default). Entries can be tagged, e.g. by the
+    workspace they belong to, and dropped by tag with invalidate().
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key: (expires, value, tags, etag)
+        self._tags = {}  # tag: set of keys
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        expires, value, tags, etag = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+        return expires, value, tags, etag
+
+    def get(self, key):
+        """ Return cached value or None if it is missing or expired """
+        with self._lock:
+            if key not in self._data:
+                return None
+            entry = self._data.pop(key)
+            self._data[key] = entry  # move to the end
+            expires, value, tags, etag = entry
+            if expires is not None and expires < time.time():
+                if etag is None:  # can't be revalidated, drop it
+                    self._pop(key)
+                return None
+            return value
+
+    def get_stale(self, key):
+        """ Return (value, etag) of an entry which can be revalidated with
+        a conditional request even if it is expired, None otherwise """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[3] is None:
+                return None
+            return entry[1], entry[3]
+
+    def set(self, key, value, ttl=None, tags=(), etag=None):
+        """ Store a value
+        :param ttl: time to live in seconds, None to keep forever
+        :param tags: iterable of tags to invalidate the entry by
+        :param etag: ETag of the response, keeps the entry for revalidation
+            after it expires
+        """
+        expires = None if ttl is None else time.time() + ttl
+        tags = frozenset(tags)
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (expires, value, tags, etag)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.max_entries is not None and \
+                    len(self._data) > self.max_entries:
+                self._pop(next(iter(self._data)))
+
+    def invalidate(self, *tags):
+        """ Drop all entries having any of the tags """
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+
+class SQLiteCache(object):
+    """ Persistent cache backend storing zlib-compressed JSON in SQLite
+
+    The total size of stored (compressed) values is bounded by `max_size`
+    bytes, least recently used entries are evicted first.
+
+    Example:
+        toggl = Toggl(api_token, cache=SQLiteCache('toggl_cache.sqlite'))
+    """
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL,
+                accessed REAL NOT NULL,
+                etag TEXT);
+            CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed);
+            CREATE TABLE IF NOT EXISTS cache_tags (
+                tag TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (tag, key));
+            CREATE INDEX IF NOT EXISTS cache_tags_key ON cache_tags(key);
+        """)
+        self._db.commit()
+
+    def get(self, key):
+        """ Return cached value or None if it is missing or expired """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires, etag FROM cache WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires, etag = row
+            if expires is not None and expires < now:
+                if etag is None:  # can't be revalidated, drop it
+                    self._delete([key])
+                    self._db.commit()
+                return None
+            self._db.execute("UPDATE cache SET accessed = ? WHERE key = ?",
+                             (now, key))
+            self._db.commit()
+        return json.loads(zlib.decompress(value).decode('utf8'))
+
+    def get_stale(self, key):
+        """ Return (value, etag) of an entry which can be revalidated with
+        a conditional request even if it is expired, None otherwise """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, etag FROM cache WHERE key = ? AND "
+                "etag IS NOT NULL", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode('utf8')), row[1]
+
+    def set(self, key, value, ttl=None, tags=(), etag=None):
+        """ Store a JSON-serializable value
+        :param ttl: time to live in seconds, None to keep forever
+        :param tags: iterable of tags to invalidate the entry by
+        :param etag: ETag of the response, keeps the entry for revalidation
+            after it expires
+        """
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        blob = zlib.compress(json.dumps(value).encode('utf8'))
+        with self._lock:
+            self._delete([key])
+            self._db.execute(
+                "INSERT INTO cache (key, value, size, expires, accessed, etag)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(blob), len(blob), expires, now, etag))
+            self._db.executemany("INSERT INTO cache_tags VALUES (?, ?)",
+                                 ((tag, key) for tag in set(tags)))
+            self._evict()
+            self._db.commit()
+
+    def _delete(self, keys):
+        keys = [(key,) for key in keys]
+        self._db.executemany("DELETE FROM cache WHERE key = ?", keys)
+        self._db.executemany("DELETE FROM cache_tags WHERE key = ?", keys)
+
+    def _evict(self):
+        """ Drop expired entries, then LRU ones until under max_size
+        Expired entries with an ETag are kept for revalidation """
+        self._delete(key for key, in self._db.execute(
+            "SELECT key FROM cache WHERE expires < ? AND etag IS NULL",
+            (time.time(),)).fetchall())
+        total, = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()
+        if total <= self.max_size:
+            return
+        evicted = []
+        for key, size in self._db.execute(
+                "SELECT key, size FROM cache ORDER BY accessed").fetchall():
+            evicted.append(key)
+            total -= size
+            if total <= self.max_size:
+                break
+        self._delete(evicted)
+
+    def invalidate(self, *tags):
+        """ Drop all entries having any of the tags """
+        with self._lock:
+            self._delete(set(key for tag in tags for key, in self._db.execute(
+                "SELECT key FROM cache_tags WHERE tag = ?", (tag,))))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM cache")
+            self._db.execute("DELETE FROM cache_tags")
+            self._db.commit()
+
+
+class MetadataIndex(object):
+    """ Workspaces, workspace users and projects of a Toggl client, fetched
+    once and indexed by id
+
+    Tables are loaded on first use and kept until refresh(), so report code
+    can join time entries to users and projects by id for free:
+
+        users = toggl.metadata.users(wid)
+        name = users[record['uid']]['name']
+
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, toggl):
+        self.toggl = toggl
+        self._workspaces = None  # OrderedDict id: workspace
+        self._users = {}  # wid: OrderedDict uid: workspace user
+        self._projects = {}  # wid: OrderedDict pid: project
+        self._inactive = {}  # wid: frozenset of uids of disabled users
+        self._lock = threading.RLock()
+
+    def _fetch_workspaces(self):
+        return self.toggl.get_workspaces()
+
+    def _fetch_users(self, wid):
+        return self.toggl.get_workspace_users(wid)
+
+    def _fetch_projects(self, wid):
+        # including archived ones, time entries can still refer to them
+        return self.toggl._request(
+            '/api/v8/workspaces/{0}/projects'.format(wid),
+            {'active': 'both'}) or []
+
+    def workspaces(self):
+        """ Workspaces available for reports, see Toggl.get_workspaces()
+        :return: OrderedDict id: workspace dict, in the API order
+        """
+        with self._lock:
+            if self._workspaces is None:
+                self._workspaces = OrderedDict(
+                    (w['id'], w) for w in self._fetch_workspaces())
+            return self._workspaces
+
+    def users(self, wid):
+        """ Workspace users, including disabled ones
+        :return: OrderedDict user id (uid): workspace user dict
+        """
+        with self._lock:
+            if wid not in self._users:
+                self._users[wid] = OrderedDict(
+                    (u['uid'], u) for u in self._fetch_users(wid))
+            return self._users[wid]
+
+    def projects(self, wid):
+        """ Workspace projects, including archived ones
+        :return: OrderedDict project id: project dict
+        """
+        with self._lock:
+            if wid not in self._projects:
+                self._projects[wid] = OrderedDict(
+                    (p['id'], p) for p in self._fetch_projects(wid))
+            return self._projects[wid]
+
+    def inactive_users(self, wid):
+        """ Ids of disabled users of the workspace, as a frozenset """
+        with self._lock:
+            if wid not in self._inactive:
+                self._inactive[wid] = frozenset(
+                    uid for uid, u in self.users(wid).items()
+                    if u.get('inactive'))
+            return self._inactive[wid]
+
+    def _merge(self, table, items, key):
+        """ Update a table with fresh items, keeping the old dicts of items
+        which haven't changed since, judging by their `at`
+        :return: (new table, set of keys of new, changed and deleted items)
+        """
+        fresh = OrderedDict()
+        changed = set()
+        for item in items:
+            old = table.get(item[key])
+            if old is not None and old.get('at') == item.get('at'):
+                item = old
+            else:
+                changed.add(item[key])
+            fresh[item[key]] = item
+        return fresh, changed | (set(table) - set(fresh))
+
+    def refresh(self):
+        """ Fetch all loaded tables again, bypassing the response cache
+        Items modified since (by their `at`) are replaced, deleted ones are
+        dropped.
+        :return: set of ids of workspaces whose workspace, users or projects
+            have changed, i.e. empty (false) if nothing has
+        """
+        with self._lock:
+            tags = ['workspaces']
+            tags.extend('workspace:%s/workspace_users' % wid
+                        for wid in self._users)
+            tags.extend('workspace:%s/projects' % wid
+                        for wid in self._projects)
+            self.toggl._invalidate(*tags)
+
+            changed = set()
+            if self._workspaces is not None:
+                self._workspaces, changed = self._merge(
+                    self._workspaces, self._fetch_workspaces(), 'id')
+            for wid in list(self._users):
+                self._users[wid], c = self._merge(
+                    self._users[wid], self._fetch_users(wid), 'uid')
+                if c:
+                    self._inactive.pop(wid, None)
+                    changed.add(wid)
+            for wid in list(self._projects):
+                self._projects[wid], c = self._merge(
+                    self._projects[wid], self._fetch_projects(wid), 'id')
+                if c:
+                    changed.add(wid)
+            return changed
+
+
+class BaseToggl(object):
+    """ Transport independent part of Toggl API clients
+
+    Settings, response caching and filtering, and API methods returning the
+    result of _request() as is. Requests are sent by subclasses: Toggl over
+    blocking connections, async_toggl.AsyncToggl over asyncio streams.
     """
     baseURL = 'toggl.com'
+    scheme = 'https'
     date_format = '%Y-%m-%d'  # YYYY-MM-DD
-    connection = None
+    # transport settings
+    timeout = 60  # seconds, for every request
+    pool_size = 8  # max number of idle keep-alive connections
+    read_chunk_size = 64 * 1024
+    # methods safe to send again if a reused connection fails: the server
+    # could have applied the request before the connection was reset
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE')
+    metrics = None  # request hooks, e.g. Metrics()
     # rate limit settings
-    _rate_limit_pause = 0  # it's adaptive. Don't change at runtime
-    retries = 3
-    # rate caching
-    cache = True
-    _cache = None
+    rate_limiter = RateLimiter()  # shared by all instances unless overridden
+    retries = 5
+    backoff_base = 1  # seconds, doubled on every retry
+    backoff_max = 60
+    # max number of detailed report pages fetched concurrently
+    page_workers = 4
+    # max number of concurrent requests of bulk operations, e.g. sync_projects
+    bulk_workers = 4
+    # response caching
+    cache = None  # cache backend, e.g. MemoryCache or SQLiteCache
+    # time to live of cached responses, in seconds, by the last part of the API
+    # function url. None means "keep forever". Reports are handled separately,
+    # see _cache_ttl()
+    cache_ttl = {
+        'workspaces': 24 * 3600,
+        'workspace_users': 3600,
+        'projects': 3600,
+        'me': 24 * 3600,
+        'time_entries': 0,
+    }
+    default_cache_ttl = 3600
+    # workspace id and resource of an API function url, e.g.
+    # /api/v8/workspaces/123/projects
+    _workspace_url = re.compile(r'/workspaces(?:/(\d+)(?:/(\w+))?)?')
+    _url_id = re.compile(r'/\d+(?=/|$)')
     urlencode = None
 
-    def __init__(self, api_token, cache=True):
+    def __init__(self, api_token, cache=True, rate_limiter=None,
+                 base_url=None, timeout=None, metrics=None):
+        """
+        :param api_token: Toggl API token
+        :param cache: True to cache responses in memory, False to disable
+            caching, or a cache backend instance (e.g. SQLiteCache)
+        :param rate_limiter: RateLimiter instance, by default the one shared
+            by all Toggl clients in the process
+        :param base_url: API location as scheme://host[:port], by default
+            https://toggl.com. Useful to run against a local test server
+        :param timeout: socket timeout of every request in seconds
+        :param metrics: Metrics instance or another object with the same
+            on_*() hooks, to collect request statistics
+        """
+        if base_url is not None:
+            self.scheme, self.baseURL = base_url.rstrip('/').split('://', 1)
+        if timeout is not None:
+            self.timeout = timeout
+        if metrics is not None:
+            self.metrics = metrics
         auth = api_token + ':api_token'
         if sys.version_info > (3,):  # Python 2/3 compatibility
-            import http.client
             import urllib.parse
             self.urlencode = urllib.parse.urlencode
-            self.connection = http.client.HTTPSConnection(self.baseURL)
             auth = bytes(auth, 'ascii')
         else:
-            import httplib
             import urllib
             self.urlencode = urllib.urlencode
-            self.connection = httplib.HTTPSConnection(self.baseURL)
 
         self.logger = logging.getLogger(__name__)
         self.auth_header = {'Authorization': "Basic %s" %
                                     base64.b64encode(auth).rstrip().decode()}
-        self.cache = cache
-        self.flush()
+        if cache is True:
+            cache = MemoryCache()
+        self.cache = cache or None
+        if rate_limiter is not None:
+            self.rate_limiter = rate_limiter
 
     def flush(self):
-        self._cache = {}
-
-    def _get_json(self, url, method='GET', body=None):
-        self.logger.debug("_get_json: url=%s, method=%s, body=%s" %
-                          (url, method, body))
-        # Caching
-        if self.cache and method == 'GET' and url in self._cache:
-            self.logger.debug("Cache hit! returning from cache: %s" %
-                              json.dumps(self._cache[url]))
-            return self._cache[url]
-
-        self.connection.request(method, url, body, self.auth_header)
-        try:
-            response = self.connection.getresponse()
-        except:
-            self.logger.error('Failed to open url: %s' % url)
-            raise
-        response_text = response.read()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _invalidate(self, *tags):
+        """ Drop cached responses having any of the tags """
+        if self.cache is not None and tags:
+            self.cache.invalidate(*tags)
+
+    def _cache_tags(self, api_func, params=None):
+        """ Tags of a cached API response, to invalidate it by writes
+        The list of workspaces is tagged 'workspaces', everything specific to
+        a workspace is tagged 'workspace:<id>' and 'workspace:<id>/<resource>'
+        e.g. 'workspace:123/projects' or 'workspace:123/reports'
+        """
+        if api_func.startswith('/reports/'):
+            wid, resource = (params or {}).get('workspace_id'), 'reports'
+        else:
+            match = self._workspace_url.search(api_func)
+            if match is None:
+                return []
+            wid, resource = match.groups()
+        if wid is None:
+            return ['workspaces']
+        tags = ['workspace:%s' % wid]
+        if resource is not None:
+            tags.append('workspace:%s/%s' % (wid, resource))
+        return tags
+
+    def _write_tags(self, api_func):
+        """ Tags of cached responses made stale by a write to the API function
+        Writes to a workspace resource (e.g. projects) only affect that
+        resource, creating or leaving a workspace affects the list of
+        workspaces and, in the latter case, everything in the workspace.
+        """
+        match = self._workspace_url.search(api_func)
+        if match is None:
+            return []
+        wid, resource = match.groups()
+        if wid is None:
+            return ['workspaces']
+        if resource is None or resource == 'leave':
+            return ['workspaces', 'workspace:%s' % wid]
+        return ['workspace:%s/%s' % (wid, resource)]
+
+    def _endpoint(self, url):
+        """ API endpoint of the url for metrics, e.g.
+        /api/v8/workspaces/{id}/projects """
+        return self._url_id.sub('/{id}', url.split('?', 1)[0])
+
+    def _cache_ttl(self, api_func, params=None):
+        """ Get time to live for a cached response of the API function
+        Reports on fully closed weeks (`until` is in the past) can't change
+        and are kept forever, reports including today are never cached.
+        :return: ttl in seconds, None for "forever" or 0 for "do not cache"
+        """
+        if api_func.startswith('/reports/'):
+            until = (params or {}).get('until')
+            today = datetime.date.today().strftime(self.date_format)
+            if until is not None and until < today:
+                return None
+            return 0
+        return self.cache_ttl.get(api_func.rstrip('/').rsplit('/', 1)[-1],
+                                  self.default_cache_ttl)
+
+    def _lookup(self, url):
+        """ Look a response up in the cache
+        :return: (cached response or None, stale), where stale is a pair of
+            an expired response and its ETag to revalidate it, or None
+        """
+        response_json = self.cache.get(url)
+        if self.metrics is not None:
+            self.metrics.on_cache(self._endpoint(url),
+                                  response_json is not None)
+        if response_json is not None:
+            self.logger.debug("Cache hit: %s", url)
+            return response_json, None
+        return None, self.cache.get_stale(url)
 
+    def _headers(self, stale=None):
+        """ Request headers, conditional if there is a stale response """
+        if stale is None:
+            return self.auth_header
+        return dict(self.auth_header, **{'If-None-Match': stale[1]})
+
+    def _handle_response(self, url, response, response_text, use_cache,
+                         cache_ttl=None, cache_tags=(), stale=None):
+        """ Check the response status, decode and cache the response
+        :param response: response object with `status` and getheader()
+        :param response_text: decompressed response body, bytes
+        :return: decoded response, raises TogglException on errors
+        """
         if response.status == 429:
-            self.logger.debug("Hit API request rate limit, pause for 2 sec")
-            raise TogglRateLimitException("Status 429 returned by Toggl API")
+            self.logger.debug("Hit API request rate limit")
+            try:
+                retry_after = float(response.getheader('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = None
+            raise TogglRateLimitException("Status 429 returned by Toggl API",
+                                          retry_after=retry_after)
+
+        elif response.status == 304 and stale is not None:
+            self.logger.debug("Not modified: %s" % url)
+            self.cache.set(url, stale[0], cache_ttl, cache_tags, stale[1])
+            return stale[0]
 
         elif response.status > 200:
             raise TogglException(
                 "API call %s returned status %s. The response was:\n %s" %
                 (url, response.status, response_text))
 
-        self.logger.debug("Response from Toggl: %s" % response_text)
+        self.logger.debug("Response from Toggl: %s", response_text)
         response_json = json.loads(response_text.decode('utf8'))
         if 'error' in response_json:
             raise TogglException("""Error getting Toggl data:
@@ -90,14 +796,294 @@ class Toggl(object):
             tip: %(tip)s
             code: %(code)s""" % response_json['error'])
 
-        if self.cache and method == 'GET':
-            self._cache[url] = response_json
+        if use_cache:
+            self.cache.set(url, response_json, cache_ttl, cache_tags,
+                           response.getheader('ETag'))
 
         return response_json
 
+    def _backoff(self, attempt, retry_after=None):
+        """ Time to pause after a rate limited request, in seconds
+        Retry-After is honored if the API provided it, otherwise it is a
+        jittered exponential back-off.
+        """
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def _url(self, api_func, params=None):
+        query = '' if params is None else '?' + self.urlencode(params)
+        return api_func + query
+
+    def _filter(self, response, filters=None):
+        """ Objects of the response list having all the fields as in filters
+        """
+        if filters is None:
+            return response
+        return [i for i in response
+                if all(i.get(k) == v for k, v in filters.items())]
+
+    def get_projects(self, wid, **filters):
+        """ Get projects information
+        :param wid: toggle workspace id, obtained from get_workspaces
+        :return: list of active project dicts. Example: [
+            {   "id":909,
+                "wid":777,
+                "cid":987,
+                "name":"Very lucrative project",
+                "billable":false,
+                "is_private":true,
+                "active":true,
+                "at":"2013-03-06T09:15:18+00:00" },
+            ... ]
+
+        https://github.com/toggl/toggl_api_docs/blob/master/chapters/workspaces.md#get-workspace-projects
+        """
+        return self._request(
+            '/api/v8/workspaces/{0}/projects'.format(wid),
+            filters=filters)
+
+    @staticmethod
+    def _project_tasks(existing, desired_projects, archive=False):
+        """ Changes to apply by sync_projects()
+        :param existing: dict of existing projects by name
+        :return: list of (action, project_id or None, fields) tuples, action
+            is one of 'created', 'updated' and 'archived'
+        """
+        desired = OrderedDict()
+        for project in desired_projects:
+            if not isinstance(project, dict):
+                project = {'name': project}
+            desired[project['name']] = project
+
+        tasks = []
+        for name, fields in desired.items():
+            if name not in existing:
+                params = {'is_private': False, 'active': True}
+                params.update(fields)
+                tasks.append(('created', None, params))
+                continue
+            project = existing[name]
+            changes = {k: v for k, v in fields.items()
+                       if project.get(k) != v}
+            if not project.get('active', True) and 'active' not in fields:
+                changes['active'] = True  # unarchive
+            if changes:
+                tasks.append(('updated', project['id'], changes))
+        if archive:
+            tasks.extend(('archived', p['id'], {'active': False})
+                         for name, p in existing.items()
+                         if name not in desired and p.get('active', True))
+        return tasks
+
+    def _apply_project_task(self, wid, task):
+        """ Apply a change of _project_tasks()
+        :return: project instance
+        """
+        action, project_id, params = task
+        if action == 'created':
+            params['wid'] = wid
+            return self._request('/api/v9/workspaces/%s/projects' % wid,
+                                 method='POST', body=json.dumps(params))
+        return self.update_project(wid, project_id, **params)
+
+    def update_project(self, wid, project_id, **params):
+        """  Add projects to the specified workspace.
+        :param wid: workspace id
+        :param project_id: str project name
+        :return: project instance
+
+        Undocumented
+        """
+        params.update({
+            'guid': project_id,
+            'wid': wid
+        })
+        return self._request('/api/v9/workspaces/%s/projects/%s' %
+                             (wid, project_id),
+                             method='PUT', body=json.dumps(params))
+
+    def delete_project(self, wid, project_id):
+        """ Delete workspaces with the specified IDs
+        :param wid: int workspace id
+        :param project_id: str or int project id
+        :returns None. Raises Toggl exception if something went wrong
+
+        Undocumented
+        """
+        return self._request('/api/v9/workspaces/%s/projects/%s' %
+                             (wid, project_id), method='DELETE')
+
+    def weekly_report(self, wid, since, until):
+        """ Toggl weekly report for a given team """
+        return self._request('/reports/api/v2/weekly', {
+            'workspace_id': wid,
+            'since': since.strftime(self.date_format),
+            'until': until.strftime(self.date_format),
+            'user_agent': 'github.com/user2589/Toggl.py',
+            'order_field': 'title',
+            # title/day1/day2/day3/day4/day5/day6/day7/week_total
+            'display_hours': 'decimal',  # decimal/minutes
+        })
+
+    def _detailed_report_page(self, wid, since, until, page):
+        return self._request('/reports/api/v2/details', {
+            'workspace_id': wid,
+            'since': since.strftime(self.date_format),
+            'until': until.strftime(self.date_format),
+            'user_agent': 'github.com/user2589/Toggl.py',
+            'order_field': 'date',
+            # date/description/duration/user in detailed reports
+            'order_desc': 'off',  # on/off
+            'display_hours': 'decimal',  # decimal/minutes
+            'page': page
+        })
+
+    def get_me(self):
+        """ Get the API token owner profile, e.g. {
+                'id': 5123,
+                'fullname': 'John Swift',
+                'timezone': 'Europe/Berlin',
+                ...
+            }
+
+        https://engineering.toggl.com/docs/api/me
+        """
+        return self._request('/api/v9/me')
+
+
+class Toggl(BaseToggl):
+    """ Class to access Toggl API
+
+    API docs can be found at:
+    https://github.com/toggl/toggl_api_docs/blob/master/reports.md
+    """
+    _connection_class = None
+    # errors of a request over a keep-alive connection closed by the server
+    _connection_errors = ()
+    # changes made within this many seconds before a sync are fetched again
+    # by the next one, to tolerate clock skew and late writes
+    sync_margin = 300
+    # changes API only covers the token owner's entries, so in workspaces of
+    # several users sync_changes() re-fetches this many weeks before the
+    # previous sync. None means the whole synced period
+    sync_lookback = None
+
+    def __init__(self, api_token, cache=True, rate_limiter=None,
+                 base_url=None, timeout=None, metrics=None):
+        """ Parameters are the same as of BaseToggl """
+        super(Toggl, self).__init__(api_token, cache, rate_limiter, base_url,
+                                    timeout, metrics)
+        if sys.version_info > (3,):  # Python 2/3 compatibility
+            import http.client
+            self._connection_class = http.client.HTTPSConnection \
+                if self.scheme == 'https' else http.client.HTTPConnection
+            # RemoteDisconnected is a BadStatusLine, BrokenPipeError and
+            # ConnectionResetError are ConnectionErrors
+            self._connection_errors = (http.client.BadStatusLine,
+                                       ConnectionError)
+        else:
+            import httplib
+            import socket
+            self._connection_class = httplib.HTTPSConnection \
+                if self.scheme == 'https' else httplib.HTTPConnection
+            self._connection_errors = (httplib.BadStatusLine, socket.error)
+        # connections are not thread safe, so every request takes one from
+        # the pool and returns it once the response is read
+        self.pool = ConnectionPool(self._connect, self.pool_size)
+        # workspaces, users and projects by id, loaded on demand
+        self.metadata = MetadataIndex(self)
+
+    def _connect(self):
+        return self._connection_class(self.baseURL, timeout=self.timeout)
+
+    def close(self):
+        """ Close idle connections to the API """
+        self.pool.close()
+
+    def _get_json(self, url, method='GET', body=None, cache_ttl=None,
+                  cache_tags=()):
+        self.logger.debug("_get_json: url=%s, method=%s, body=%s",
+                          url, method, body)
+        use_cache = self.cache is not None and method == 'GET' and \
+            cache_ttl != 0
+        stale = None
+        if use_cache:
+            response_json, stale = self._lookup(url)
+            if response_json is not None:
+                return response_json
+
+        throttled = self.rate_limiter.acquire()
+        started = time.time()
+        status = size = None
+        try:
+            response, response_text, size = self._send(
+                method, url, body, self._headers(stale))
+            status = response.status
+        finally:
+            if self.metrics is not None:
+                self.metrics.on_request(self._endpoint(url), status,
+                                        time.time() - started, size or 0,
+                                        throttled)
+        return self._handle_response(url, response, response_text, use_cache,
+                                     cache_ttl, cache_tags, stale)
+
+    def _send(self, method, url, body, headers):
+        """ Send a request over a pooled connection
+        Keep-alive connections can be closed by the server at any moment, so
+        an idempotent request failed over a reused connection is retried once
+        over a new one.
+        :return: (response, response body, number of bytes received), the
+            body is decompressed
+        """
+        headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+        for attempt in range(2):
+            connection = self.pool.acquire()
+            reused = connection.sock is not None
+            try:
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+                response_text, size = self._read(response)
+            except self._connection_errors:
+                connection.close()
+                if reused and attempt == 0 and \
+                        method in self.idempotent_methods:
+                    self.logger.debug("Connection was closed, reconnecting")
+                    continue
+                self.logger.error('Failed to open url: %s' % url)
+                raise
+            except Exception:
+                connection.close()
+                self.logger.error('Failed to open url: %s' % url)
+                raise
+            self.pool.release(connection)
+            return response, response_text, size
+
+    def _read(self, response):
+        """ Read the response body, decompressing it as it arrives
+        :return: (body, number of bytes received)
+        """
+        if (response.getheader('Content-Encoding') or '').lower() != 'gzip':
+            body = response.read()
+            return body, len(body)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip header
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(self.read_chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            chunks.append(decompressor.decompress(chunk))
+        chunks.append(decompressor.flush())
+        return b''.join(chunks), size
+
     def _request(self, api_func, params=None, body=None, method='GET',
                  filters=None):
         """  Internal method to call Toggl API
+        Writes (any method but GET) invalidate cached responses they affect,
+        see _write_tags()
         :param api_func: url of the API function without the hostname
         :param params: query string params (aka GET params)
         :param body: If body present, a POST request is issued
@@ -106,27 +1092,32 @@ class Toggl(object):
         :return: arbitrary object or a list of objects retured by the specified
                 API function and filtered with the specified filters
         """
-        query = '' if params is None else '?' + self.urlencode(params)
-        url = api_func + query
+        url = self._url(api_func, params)
         if body is not None and method == 'GET':
             method = 'POST'
+        cache_ttl = self._cache_ttl(api_func, params)
+        cache_tags = self._cache_tags(api_func, params)
 
-        for i in range(self.retries):
-            try:
-                response = self._get_json(url, method, body=body)
-            except TogglRateLimitException as e:
-                if i == self.retries - 1:
-                    raise e
-                self._rate_limit_pause += 1
-                time.sleep(self._rate_limit_pause)
-            else:
-                self._rate_limit_pause = max(0, self._rate_limit_pause - 1)
-                break
-
-        if filters is None:
-            return response
-        return [i for i in response
-                if all(i.get(k) == v for k, v in filters.items())]
+        try:
+            for i in range(self.retries):
+                try:
+                    response = self._get_json(url, method, body=body,
+                                              cache_ttl=cache_ttl,
+                                              cache_tags=cache_tags)
+                except TogglRateLimitException as e:
+                    if i == self.retries - 1:
+                        raise e
+                    delay = self._backoff(i, e.retry_after)
+                    if self.metrics is not None:
+                        self.metrics.on_retry(self._endpoint(url), delay)
+                    self.rate_limiter.pause(delay)
+                else:
+                    break
+        finally:
+            # even a failed write might have been applied
+            if method != 'GET':
+                self._invalidate(*self._write_tags(api_func))
+        return self._filter(response, filters)
 
     def get_workspaces(self, **filters):
         """ Get the list of workspaces
@@ -196,26 +1187,6 @@ class Toggl(object):
             '/api/v8/workspaces/{0}/workspace_users'.format(wid),
             filters=filters)]
 
-    def get_projects(self, wid, **filters):
-        """ Get projects information
-        :param wid: toggle workspace id, obtained from get_workspaces
-        :return: list of active project dicts. Example: [
-            {   "id":909,
-                "wid":777,
-                "cid":987,
-                "name":"Very lucrative project",
-                "billable":false,
-                "is_private":true,
-                "active":true,
-                "at":"2013-03-06T09:15:18+00:00" },
-            ... ]
-
-        https://github.com/toggl/toggl_api_docs/blob/master/chapters/workspaces.md#get-workspace-projects
-        """
-        return self._request(
-            '/api/v8/workspaces/{0}/projects'.format(wid),
-            filters=filters)
-
     def add_project(self, wid, project_name, is_private=False, active=True):
         """ Create a project in the workspace
         :param wid: int workspace id
@@ -223,8 +1194,10 @@ class Toggl(object):
         :param is_private: visible to all workspace members
         :param active: visible in the workspace
         :return: project instance if project was created, None otherwise
+
+        To create many projects at once, use sync_projects()
         """
-        existing_projects = [p['name'] for p in self.get_projects(wid)]
+        existing_projects = set(p['name'] for p in self.get_projects(wid))
         if project_name not in existing_projects:
             params = {
                 'wid': wid,
@@ -235,69 +1208,181 @@ class Toggl(object):
             return self._request('/api/v9/workspaces/%s/projects' % wid,
                                  method='POST', body=json.dumps(params))
 
-    def update_project(self, wid, project_id, **params):
-        """  Add projects to the specified workspace.
-        :param wid: workspace id
-        :param project_id: str project name
-        :return: project instance
+    def sync_projects(self, wid, desired_projects, archive=False):
+        """ Create, update and archive workspace projects to match the list
 
-        Undocumented
+        Existing projects (including archived) are fetched once and indexed
+        by name, the difference is applied by up to `bulk_workers`
+        concurrent requests. Cached project lists of the workspace are
+        invalidated.
+        :param wid: int workspace id
+        :param desired_projects: list of project names or dicts with 'name'
+            and other project fields, e.g. {'name': 'Team 1', 'is_private':
+            True}. New projects are public and active unless specified
+        :param archive: deactivate existing projects missing from the list
+        :return: dict with lists of 'created', 'updated' and 'archived'
+            project instances
         """
-        params.update({
-            'guid': project_id,
-            'wid': wid
-        })
-        return self._request('/api/v9/workspaces/%s/projects/%s' %
-                             (wid, project_id),
-                             method='PUT', body=json.dumps(params))
+        self._invalidate('workspace:%s/projects' % wid)
+        existing = {p['name']: p for p in self._request(
+            '/api/v8/workspaces/{0}/projects'.format(wid),
+            {'active': 'both'}) or []}
 
-    def delete_project(self, wid, project_id):
-        """ Delete workspaces with the specified IDs
-        :param wid: int workspace id
-        :param project_id: str or int project id
-        :returns None. Raises Toggl exception if something went wrong
+        tasks = self._project_tasks(existing, desired_projects, archive)
 
-        Undocumented
+        def apply(task):
+            return self._apply_project_task(wid, task)
+
+        result = {'created': [], 'updated': [], 'archived': []}
+        if tasks:
+            pool = ThreadPool(min(self.bulk_workers, len(tasks)))
+            try:
+                for (action, _, _), project in zip(tasks,
+                                                   pool.map(apply, tasks)):
+                    result[action].append(project)
+            finally:
+                pool.close()
+        return result
+
+    def iter_detailed_report(self, wid, since, until, fields=None):
+        """ Toggl detailed report for a given team, record by record
+
+        Records are yielded page by page, so memory use doesn't depend on the
+        report size. The first page tells how many pages there are, the rest
+        of them are fetched in batches of `page_workers` concurrent requests.
+
+        :param fields: optional list of record fields to keep, e.g.
+            ['user', 'project', 'start', 'dur']. All fields are kept by default
+        :return: generator of record dicts
+
+        https://github.com/toggl/toggl_api_docs/blob/master/reports/detailed.md#example
         """
-        return self._request('/api/v9/workspaces/%s/projects/%s' %
-                             (wid, project_id), method='DELETE')
+        def records(report_page):
+            if fields is None:
+                return report_page['data']
+            return ({f: r.get(f) for f in fields} for r in report_page['data'])
 
-    def weekly_report(self, wid, since, until):
-        """ Toggl weekly report for a given team """
-        return self._request('/reports/api/v2/weekly', {
-            'workspace_id': wid,
-            'since': since.strftime(self.date_format),
-            'until': until.strftime(self.date_format),
-            'user_agent': 'github.com/user2589/Toggl.py',
-            'order_field': 'title',
-            # title/day1/day2/day3/day4/day5/day6/day7/week_total
-            'display_hours': 'decimal',  # decimal/minutes
-        })
+        def fetch(page):
+            return self._detailed_report_page(wid, since, until, page)
+
+        report_page = fetch(1)
+        per_page = report_page['per_page']
+        pages = (report_page['total_count'] + per_page - 1) // per_page
+        for record in records(report_page):
+            yield record
+        if pages < 2:
+            return
+
+        pool = ThreadPool(min(self.page_workers, pages - 1))
+        try:
+            for batch in range(2, pages + 1, self.page_workers):
+                batch_pages = range(batch,
+                                    min(batch + self.page_workers, pages + 1))
+                for report_page in pool.map(fetch, batch_pages):
+                    for record in records(report_page):
+                        yield record
+        finally:
+            pool.close()
+
+    def detailed_report_count(self, wid, since, until):
+        """ Number of records in the detailed report
+        Only the first page is fetched, to be reused from the cache by
+        iter_detailed_report() on closed periods
+        """
+        return self._detailed_report_page(wid, since, until,
+                                          1)['total_count']
 
     def detailed_report(self, wid, since, until):
         """ Toggl detailed report for a given team
+        :return: list of record dicts, see iter_detailed_report()
+        """
+        return list(self.iter_detailed_report(wid, since, until))
 
-        https://github.com/toggl/toggl_api_docs/blob/master/reports/detailed.md#example
+    def changed_time_entries(self, wid, since):
+        """ Time entries of the workspace changed since the given time,
+        including deleted ones
+
+        Toggl only offers this for entries visible to the API token owner.
+        Entry start is converted to the owner's timezone, as in reports.
+        :param wid: workspace id
+        :param since: unix timestamp
+        :return: list of dicts in the format of detailed report records:
+            id, uid, user, pid, project, start, dur, updated. Deleted entries
+            also have 'deleted': True. Raises TogglException if the API
+            doesn't support it.
+
+        https://engineering.toggl.com/docs/api/time_entries#get-timeentries
         """
-        page = 1
-        records_read = 0
+        if ZoneInfo is None:
+            raise TogglException("Timezone support (Python 3.9+) is "
+                                 "required to sync changed time entries")
+        timezone = ZoneInfo(self.get_me()['timezone'])
+        users = self.metadata.users(wid)
+        projects = self.metadata.projects(wid)
+
         records = []
-        while True:
-            report_page = self._request('/reports/api/v2/details', {
-                'workspace_id': wid,
-                'since': since.strftime(self.date_format),
-                'until': until.strftime(self.date_format),
-                'user_agent': 'github.com/user2589/Toggl.py',
-                'order_field': 'date',
-                # date/description/duration/user in detailed reports
-                'order_desc': 'off',  # on/off
-                'display_hours': 'decimal',  # decimal/minutes
-                'page': page
+        for entry in self._request('/api/v9/me/time_entries',
+                                   {'since': int(since)},
+                                   filters={'workspace_id': int(wid)}):
+            if entry['duration'] < 0:  # still running
+                continue
+            start = datetime.datetime.strptime(
+                entry['start'][:19], '%Y-%m-%dT%H:%M:%S').replace(
+                tzinfo=ZoneInfo('UTC')).astimezone(timezone)
+            records.append({
+                'id': entry['id'],
+                'uid': entry['user_id'],
+                'user': users.get(entry['user_id'], {}).get('name'),
+                'pid': entry.get('project_id'),
+                'project': projects.get(entry.get('project_id'),
+                                        {}).get('name'),
+                'start': start.isoformat(),
+                'dur': entry['duration'] * 1000,
+                'updated': entry['at'],
+                'deleted': bool(entry.get('server_deleted_at')),
             })
-            records.extend(report_page['data'])
+        return records
 
-            records_read += report_page['per_page']
-            page += 1
+    def sync_changes(self, store, wid, ws_name, since):
+        """ Merge changes of the workspace time entries into a local store
 
-            if records_read >= report_page['total_count']:
-                return records
+        The caller saves the time of every sync (high-water mark) with
+        store.set_synced_at() once it has fetched the weeks returned by this
+        method, see detailed_report.sync_store(). The first sync fetches the
+        whole period. If the token owner is the only user of the workspace,
+        entries changed since the high-water mark are merged via
+        changed_time_entries() and only the weeks starting from the mark are
+        fetched again. Otherwise (the changes API doesn't cover other users'
+        entries, or is not supported) weeks are fetched again starting
+        `sync_lookback` weeks before the mark, or the whole period by default.
+        :param store: store.TimeEntryStore instance
+        :param wid: workspace id
+        :param ws_name: workspace name
+        :param since: first date of the synced period, date or datetime
+        :return: first date of the weeks to fetch again, of the type of since
+        """
+        synced = store.synced_at(wid)
+        if synced is None:
+            return since
+        synced -= self.sync_margin
+        mark = type(since).fromtimestamp(synced)
+        lookback = None
+        if set(self.metadata.users(wid)) - {self.get_me()['id']}:
+            self.logger.info("Changed entries of other users are not "
+                             "available, re-fetching weeks instead")
+            lookback = self.sync_lookback
+        else:
+            try:
+                changed = self.changed_time_entries(wid, synced)
+            except TogglException as e:
+                self.logger.info("Changed entries are not available, "
+                                 "re-fetching weeks instead: %s", e)
+                lookback = self.sync_lookback
+            else:
+                store.upsert(wid, ws_name,
+                             [r for r in changed if not r['deleted']])
+                store.delete([r['id'] for r in changed if r['deleted']])
+                lookback = 0
+        if lookback is None:
+            return since
+        return max(since, mark - datetime.timedelta(weeks=lookback))